@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+"""
+Benchmarks for csample hot paths.
+
+Every benchmark runs in a fresh child process over synthetic log lines and
+reports rows/sec, bytes/sec and the peak RSS of that process. Results can be
+saved as a baseline and compared against later runs:
+
+    python benchmarks/bench.py --rows 200000 --save baseline.json
+    python benchmarks/bench.py --rows 200000 --compare baseline.json
+
+With ``--compare`` the exit status is 1 when any benchmark got slower than
+``--threshold`` (10% by default), so it can gate a review. A benchmark which
+fails also makes the exit status 1.
+"""
+from __future__ import division, print_function
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import string
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import csample  # noqa: E402
+
+try:
+    from time import perf_counter as clock
+except ImportError:
+    from time import time as clock
+
+
+BENCHMARKS = []
+
+
+def benchmark(func):
+    BENCHMARKS.append(func)
+    return func
+
+
+def generate_lines(rows, cardinality, line_length, seed=0):
+    """Generates CSV log lines ``<timestamp>,<user>,<payload>\\n`` where the
+    user column has `cardinality` distinct values and lines are about
+    `line_length` characters long."""
+    rand = random.Random(seed)
+    letters = string.ascii_letters
+    payloads = [
+        ''.join(rand.choice(letters) for _ in range(max(line_length - 24, 1)))
+        for _ in range(64)
+    ]
+    return [
+        '%d,user%d,%s\n' % (1500000000 + i, rand.randrange(cardinality), payloads[i % 64])
+        for i in range(rows)
+    ]
+
+
+@benchmark
+def sample_tuple(lines, options):
+    tuples = [tuple(l.split(',')) for l in lines]
+    start = clock()
+    for _ in csample.sample_tuple(tuples, options.rate, 1):
+        pass
+    return clock() - start
+
+
+@benchmark
+def sample_batch(lines, options):
+    keys = [l.split(',')[1] for l in lines]
+    start = clock()
+    csample.sample_batch(keys, options.rate)
+    return clock() - start
+
+
+@benchmark
+def partition_tuple(lines, options):
+    tuples = [tuple(l.split(',')) for l in lines]
+    start = clock()
+    for partition in csample.partition_tuple(tuples, options.ratios, 1):
+        for _ in partition:
+            pass
+    return clock() - start
+
+
+@benchmark
+def partition_tuple_into(lines, options):
+    tuples = [tuple(l.split(',')) for l in lines]
+    sinks = [lambda l: None for _ in options.ratios]
+    start = clock()
+    csample.partition_tuple_into(tuples, options.ratios, 1, sinks)
+    return clock() - start
+
+
+@benchmark
+def assign_for(lines, options):
+    keys = [l.split(',')[1] for l in lines]
+    assigner = csample.HashSampler().assign_for(options.ratios)
+    start = clock()
+    for key in keys:
+        assigner(key)
+    return clock() - start
+
+
+@benchmark
+def reservoir(lines, options):
+    start = clock()
+    csample.reservoir(lines, options.size, 'seed')
+    return clock() - start
+
+
+@benchmark
+def reservoir_skip(lines, options):
+    start = clock()
+    csample.reservoir(lines, options.size, 'seed', algorithm='L')
+    return clock() - start
+
+
+@benchmark
+def cli_stdin(lines, options):
+    return _run_cli(lines, ['-r', str(options.rate), '-c', '1'], False)
+
+
+@benchmark
+def cli_input(lines, options):
+    return _run_cli(lines, ['-r', str(options.rate), '-c', '1'], True)
+
+
+def _run_cli(lines, args, direct):
+    fd, path = tempfile.mkstemp(suffix='.csv')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.writelines(lines)
+        with open(os.devnull, 'w') as sout:
+            if direct:
+                start = clock()
+                csample.main(args + ['--input', path], sys.stdin, sout)
+            else:
+                with open(path) as sin:
+                    start = clock()
+                    csample.main(args, sin, sout)
+            return clock() - start
+    finally:
+        os.remove(path)
+
+
+def _peak_rss():
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS and in kilobytes elsewhere
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def _child(name, options, conn):
+    func = dict((f.__name__, f) for f in BENCHMARKS)[name]
+    lines = generate_lines(options.rows, options.cardinality, options.line_length)
+    size = sum(len(l) for l in lines)
+    elapsed = min(func(lines, options) for _ in range(options.repeat))
+    conn.send({
+        'rows_per_sec': len(lines) / elapsed,
+        'bytes_per_sec': size / elapsed,
+        'peak_rss': _peak_rss(),
+    })
+    conn.close()
+
+
+def run(name, options):
+    """Runs benchmark `name` in a child process and returns its result.
+    Raises RuntimeError if the child exits without one."""
+    parent, child = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=_child, args=(name, options, child))
+    process.start()
+    # With the child holding the only sending end, recv() raises EOFError
+    # instead of blocking forever once the child dies
+    child.close()
+    try:
+        result = parent.recv()
+    except EOFError:
+        result = None
+    finally:
+        parent.close()
+    process.join()
+    if result is None:
+        raise RuntimeError('failed with exit code %s' % process.exitcode)
+    return result
+
+
+def parse_arguments(args):
+    parser = argparse.ArgumentParser(description='Benchmark csample hot paths')
+    parser.add_argument('names', nargs='*', help='benchmarks to run (default: all)')
+    parser.add_argument('--rows', type=int, default=100000, help='number of synthetic rows')
+    parser.add_argument('--cardinality', type=int, default=10000, help='number of distinct keys')
+    parser.add_argument('--line-length', type=int, default=80, help='approximate length of lines')
+    parser.add_argument('--rate', type=float, default=0.1, help='sampling rate')
+    parser.add_argument('--size', type=int, default=1000, help='reservoir size')
+    parser.add_argument(
+        '--ratios', type=lambda x: [float(r) for r in x.split(',')], default=[0.8, 0.1, 0.1],
+        help='comma separated partition ratios'
+    )
+    parser.add_argument('--repeat', type=int, default=3, help='runs per benchmark (best is reported)')
+    parser.add_argument('--save', type=str, help='save results as JSON baseline')
+    parser.add_argument('--compare', type=str, help='compare against JSON baseline')
+    parser.add_argument('--threshold', type=float, default=0.1, help='tolerated slowdown against baseline')
+    parser.add_argument('--list', action='store_true', help='list benchmarks and exit')
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    options = parse_arguments(args)
+    names = [f.__name__ for f in BENCHMARKS]
+    if options.list:
+        print('\n'.join(names))
+        return 0
+
+    unknown = set(options.names) - set(names)
+    if unknown:
+        raise SystemExit('Unknown benchmarks: %s' % ', '.join(sorted(unknown)))
+
+    baseline = {}
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)['results']
+
+    results = {}
+    regressions = []
+    failures = []
+    print('%-22s %14s %14s %10s %10s' % ('benchmark', 'rows/sec', 'MB/sec', 'RSS MB', 'vs base'))
+    for name in options.names or names:
+        try:
+            result = results[name] = run(name, options)
+        except RuntimeError as e:
+            failures.append(name)
+            print('%-22s %s' % (name, e))
+            continue
+        change = ''
+        if name in baseline:
+            ratio = result['rows_per_sec'] / baseline[name]['rows_per_sec']
+            change = '%.2fx' % ratio
+            if ratio < 1 - options.threshold:
+                regressions.append(name)
+                change += ' !'
+        rss = result['peak_rss']
+        print('%-22s %14.0f %14.2f %10s %10s' % (
+            name, result['rows_per_sec'], result['bytes_per_sec'] / 1e6,
+            '%.1f' % (rss / 1e6) if rss else '-', change
+        ))
+
+    if options.save:
+        with open(options.save, 'w') as f:
+            json.dump({
+                'version': csample.__version__,
+                'python': sys.version.split()[0],
+                'options': {
+                    'rows': options.rows,
+                    'cardinality': options.cardinality,
+                    'line_length': options.line_length,
+                },
+                'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+
+    if regressions:
+        print('Slower than baseline: %s' % ', '.join(regressions))
+    if failures:
+        print('Failed: %s' % ', '.join(failures))
+    return 1 if regressions or failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,14 +2,22 @@
 csample: Sampling library for Python
 """
 from __future__ import division
-import argparse
+import os
 import sys
-import random
+import math
 import itertools
+import functools
+import collections
+import bisect
+import heapq
+import operator
+import struct
+import io
+from array import array
 
-import six
-import xxhash
-import spooky
+# argparse, random, pickle and third party modules (six, hash functions) are
+# imported where they are used: the command-line interface is often run many
+# times over small inputs, so startup time matters
 
 
 __version__ = '0.6.3'
@@ -17,7 +25,106 @@ __version__ = '0.6.3'
 
 def main(args=None, sin=sys.stdin, sout=sys.stdout):
     a = parse_arguments(args)
-    write = sout.write
+
+    if not a.stats:
+        a.stats = None
+        _dispatch(a, sin, sout)
+        return
+
+    a.stats = Stats()
+    a.stats.rate = a.rate
+    report = _stats_reporter(a.stats, sys.stderr)
+    restore = _on_signal('SIGUSR1', report)
+    try:
+        _dispatch(a, sin, sout)
+    finally:
+        restore()
+        report()
+
+
+def _dispatch(a, sin, sout):
+    if a.input:
+        sin = _open_input(a.input)
+    try:
+        if isinstance(a.rate, list):
+            _sample_tiers_to_files(a, sin)
+        elif a.output:
+            with _open_output(_output_path(a.output, a.rate), a.compress_level) as f:
+                _main(a, sin, f)
+        else:
+            _main(a, sin, sout)
+    finally:
+        if a.input:
+            sin.close()
+
+
+def _output_path(template, rate):
+    return template.format(rate=rate) if '{rate}' in template else template
+
+
+def _main(a, sin, sout):
+    if _maps_input(a) and hasattr(sout, 'buffer'):
+        # Raw bytes go straight to the binary layer of `sout`
+        sout.flush()
+        out = sout.buffer if a.stats is None else _TimedStream(sout.buffer, a.stats)
+        try:
+            _sample_file(sin, out.write, a)
+        finally:
+            out.flush()
+        return
+
+    out = _output(sout, a)
+    try:
+        _run(a, sin, out.write)
+    finally:
+        out.close()
+
+
+def _sample_tiers_to_files(a, sin):
+    if a.stats is not None:
+        sin = _counted_lines(sin, a.stats)
+    if a.format != 'plain':
+        tuples = _format_tuples(sin, a.format, a.col, a.key, a.sep)
+    else:
+        tuples = _line_tuples(sin, a.col, a.sep)
+
+    files = [_open_output(_output_path(a.output, rate), a.compress_level) for rate in a.rate]
+    try:
+        outs = [_output(f, a) for f in files]
+        sinks = [_record_writer(out.write) for out in outs]
+        counts = sample_tuple_tiers(tuples, a.rate, 0, sinks, a.hash, a.seed or 'DEFAULT_SEED')
+        if a.stats is not None:
+            # A row is kept if it is written to at least one tier
+            a.stats.counts = counts
+            a.stats.rows_out = max(counts)
+        for out in outs:
+            out.close()
+    finally:
+        for f in files:
+            f.close()
+
+
+def _record_writer(write):
+    return lambda l: write(l[-1])
+
+
+def _run(a, sin, write):
+    # Live output (--line-buffered, --flush-lines or --flush-interval) is
+    # produced line by line; otherwise lines are read and sampled in chunks
+    live = a.line_buffered or a.flush_lines or a.flush_interval
+    chunked = a.method == 'hash' and a.strata_col is None and a.format == 'plain' and (a.jobs != 1 or not live)
+    stats = a.stats
+    if stats is not None and not chunked:
+        sin = _counted_lines(sin, stats)
+
+    def sampled(rows):
+        return rows if stats is None else _counted_rows(rows, stats)
+
+    def write_chunk(result):
+        text, count = result
+        if stats is not None:
+            stats.rows_out += count
+        write(text)
 
     if a.method == 'hash':
         col = a.col
@@ -26,43 +133,742 @@ def main(args=None, sin=sys.stdin, sout=sys.stdout):
         funcname = a.hash
         seed = a.seed or 'DEFAULT_SEED'
 
-        if col == -1:
-            tuples = ((l,) for l in sin)
+        if a.strata_col is not None:
+            rates = _read_rates(a.strata_file) if a.strata_file else {}
+            tuples = _strata_tuples(sin, col, a.strata_col, sep)
+            for l in sampled(sample_stratified(tuples, rates, 0, 1, funcname, seed, rate)):
+                write(l[-1])
+        elif a.format != 'plain':
+            # Records may span several lines, so they are never split into
+            # chunks for worker processes
+            tuples = _format_tuples(sin, a.format, col, a.key, sep)
+            if live:
+                for l in sampled(sample_tuple(tuples, rate, 0, funcname, seed)):
+                    write(l[-1])
+            else:
+                for chunk in _chunks(tuples, a.chunk_size):
+                    write(''.join(l[-1] for l in sampled(sample_tuple(chunk, rate, 0, funcname, seed))))
+        elif a.jobs != 1:
+            _parallel_sample(
+                _input_chunks(sin, a), write_chunk, a.jobs, not a.unordered,
+                (col, sep, rate, funcname, seed)
+            )
+        elif live:
+            tuples = _line_tuples(sin, col, sep)
+            for l in sampled(sample_tuple(tuples, rate, 0, funcname, seed)):
+                write(l[-1])
         else:
-            tuples = ((l.split(sep)[col], l) for l in sin)
-
-        for l in sample_tuple(tuples, rate, 0, funcname, seed):
-            write(l[-1])
+            for chunk in _input_chunks(sin, a):
+                write_chunk(_sample_chunk(chunk, col, sep, rate, funcname, seed))
     elif a.method == 'reservoir':
         size = int(a.rate)
         seed = a.seed or None
         keep_order = a.order
-        for l in reservoir(sin, size, seed, keep_order):
-            write(l)
+        write(''.join(sampled(reservoir(sin, size, seed, keep_order))))
+    elif a.method == 'weighted-reservoir':
+        size = int(a.rate)
+        seed = a.seed or None
+        keep_order = a.order
+        tuples = _line_tuples(sin, a.weight_col, a.sep)
+        write(''.join(l[-1] for l in sampled(weighted_reservoir(tuples, size, 0, seed, keep_order))))
+    else:
+        raise ValueError('Unknown method: %s' % a.method)
+
+
+def _input_chunks(lines, a):
+    chunks = _chunks(lines, a.chunk_size)
+    return chunks if a.stats is None else _timed_chunks(chunks, a.stats)
+
+
+def _timed_chunks(chunks, stats):
+    clock = _clock()
+    seconds = stats.seconds
+    while True:
+        start = clock()
+        chunk = next(chunks, None)
+        seconds['read'] += clock() - start
+        if chunk is None:
+            return
+        stats.rows_in += len(chunk)
+        yield chunk
+
+
+def _counted_lines(lines, stats):
+    for l in lines:
+        stats.rows_in += 1
+        yield l
+
+
+def _counted_rows(rows, stats):
+    for l in rows:
+        stats.rows_out += 1
+        yield l
+
+
+def _stats_reporter(stats, stream):
+    """Returns a function which writes `stats` as a JSON line to `stream`.
+    Time not spent reading or writing is reported as sampling time."""
+    clock = _clock()
+    start = clock()
+
+    def report(*args):
+        seconds = stats.seconds
+        seconds['total'] = clock() - start
+        seconds['sample'] = max(seconds['total'] - seconds['read'] - seconds['write'], 0.0)
+        stream.write(stats.to_json() + '\n')
+        stream.flush()
+
+    return report
+
+
+def _on_signal(name, handler):
+    """Installs `handler` for signal `name` where the platform has it and
+    returns a function restoring the previous handler."""
+    import signal
+
+    signum = getattr(signal, name, None)
+    if signum is None:
+        return lambda: None
+    try:
+        previous = signal.signal(signum, handler)
+    except ValueError:
+        # Signal handlers can only be installed in the main thread
+        return lambda: None
+    return lambda: signal.signal(signum, previous)
+
+
+def _clock():
+    try:
+        from time import perf_counter
+    except ImportError:
+        from time import time as perf_counter
+    return perf_counter
+
+
+def _output(stream, a):
+    if a.stats is not None:
+        stream = _TimedStream(stream, a.stats)
+    if a.line_buffered:
+        return _LineBufferedWriter(stream)
+    return _ChunkedWriter(stream, a.buffer_size, a.flush_lines, a.flush_interval)
+
+
+class _ChunkedWriter(object):
+    """Collects output and writes it to `stream` in large chunks.
+
+    A chunk is written once `buffer_size` characters are collected. It is also written and the stream flushed once `flush_lines`
+    lines are collected, and every `flush_interval` seconds by a background
+    thread.
+    """
+    def __init__(self, stream, buffer_size=65536, flush_lines=0, flush_interval=0):
+        self._stream = stream
+        self._buffer = []
+        self._size = 0
+        self._buffer_size = buffer_size
+        self._flush_lines = flush_lines
+        self._lines = 0
+        self._lock = None
+        self._timer = None
+        if flush_interval > 0:
+            import threading
+
+            self._lock = threading.Lock()
+            self._stopped = threading.Event()
+            self._timer = threading.Thread(target=self._flush_periodically, args=(flush_interval,))
+            self._timer.daemon = True
+            self._timer.start()
+
+    def write(self, data):
+        if self._lock is None:
+            self._append(data)
+        else:
+            with self._lock:
+                self._append(data)
+
+    def flush(self):
+        if self._lock is None:
+            self._flush()
+        else:
+            with self._lock:
+                self._flush()
+
+    def _append(self, data):
+        self._buffer.append(data)
+        self._size += len(data)
+        if self._flush_lines:
+            # Pieces may hold several lines, e.g. chunks sampled by --jobs
+            self._lines += data.count('\n')
+            if self._lines >= self._flush_lines:
+                self._flush()
+                self._stream.flush()
+                return
+        if self._size >= self._buffer_size:
+            self._flush()
+
+    def _flush(self):
+        if self._buffer:
+            self._stream.write(''.join(self._buffer))
+            del self._buffer[:]
+            self._size = 0
+            self._lines = 0
+
+    def _flush_periodically(self, interval):
+        while not self._stopped.wait(interval):
+            with self._lock:
+                self._flush()
+                self._stream.flush()
+
+    def close(self):
+        if self._timer is not None:
+            self._stopped.set()
+            self._timer.join()
+        self._flush()
+
+
+class _TimedStream(object):
+    """Adds the time spent writing to `stream` to `stats`."""
+    def __init__(self, stream, stats):
+        self._stream = stream
+        self._stats = stats
+        self._clock = _clock()
+
+    def write(self, data):
+        start = self._clock()
+        self._stream.write(data)
+        self._stats.seconds['write'] += self._clock() - start
+
+    def flush(self):
+        self._stream.flush()
+
+
+class _LineBufferedWriter(object):
+    """Writes and flushes every piece of output right away."""
+    def __init__(self, stream):
+        self._stream = stream
+
+    def write(self, data):
+        self._stream.write(data)
+        self._stream.flush()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+# File extensions of compressed --input and --output files
+_COMPRESSIONS = {
+    '.gz': 'gzip',
+    '.bz2': 'bz2',
+    '.xz': 'xz',
+    '.lzma': 'xz',
+    '.lz4': 'lz4',
+    '.zst': 'zstd',
+}
+
+
+def _compression(path):
+    return _COMPRESSIONS.get(os.path.splitext(path)[1].lower())
+
+
+def _open_input(path, block_size=1 << 20):
+    """Open `path` for reading text, decompressing it if its extension says so.
+
+    Compressed files are read and decompressed in blocks of `block_size`
+    bytes on a background thread, which runs ahead of the caller by a few
+    blocks so that decompression overlaps with hashing.
+    """
+    # Lines end at '\n' only and line endings are kept, as on standard input
+    # (which reads byte strings on Python 2)
+    if _compression(path) is None:
+        return io.open(path, newline='\n') if sys.version_info[0] >= 3 else open(path, 'rb')
+    reader = io.BufferedReader(_PrefetchReader(_open_compressed(path, 'rb'), block_size), block_size)
+    return io.TextIOWrapper(reader, newline='\n') if sys.version_info[0] >= 3 else reader
+
+
+def _open_output(path, level=None):
+    """Open `path` for writing text, compressing it at `level` (the default
+    of the format if None) if its extension says so."""
+    if _compression(path) is None:
+        return open(path, 'w')
+    # Python 2 writes byte strings, as to plain files
+    stream = _open_compressed(path, 'wb', level)
+    return io.TextIOWrapper(stream) if sys.version_info[0] >= 3 else stream
+
+
+def _open_compressed(path, mode, level=None):
+    compression = _compression(path)
+    kwargs = {}
+    if compression == 'gzip':
+        import gzip
+
+        # Level 6 like gzip(1) rather than the much slower 9 of the gzip module
+        return gzip.open(path, mode, 6 if level is None else level)
+    if compression == 'bz2':
+        import bz2
+
+        if level is not None:
+            kwargs['compresslevel'] = level
+        return bz2.BZ2File(path, mode, **kwargs)
+    if compression == 'xz':
+        lzma = _import_compression('lzma', 'lzma (Python 3.3+)')
+        if level is not None and 'w' in mode:
+            kwargs['preset'] = level
+        return lzma.open(path, mode, **kwargs)
+    if compression == 'lz4':
+        lz4_frame = _import_compression('lz4.frame', 'lz4 (pip install lz4)')
+        if level is not None:
+            kwargs['compression_level'] = level
+        return lz4_frame.open(path, mode, **kwargs)
+    if compression == 'zstd':
+        zstandard = _import_compression('zstandard', 'zstandard (pip install zstandard)')
+        if level is not None and 'w' in mode:
+            kwargs['cctx'] = zstandard.ZstdCompressor(level=level)
+        return zstandard.open(path, mode, **kwargs)
+    raise ValueError('Unknown compression of %s' % path)
+
+
+def _import_compression(name, requirement):
+    import importlib
+
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        raise ValueError('Compressed file needs %s' % requirement)
+
+
+class _PrefetchReader(io.RawIOBase):
+    """Binary raw stream which reads `stream` in blocks of `block_size` bytes
+    on a background thread, at most `blocks` blocks ahead of the reader.
+
+    Errors of the background thread are raised by the next read.
+    """
+    def __init__(self, stream, block_size=1 << 20, blocks=4):
+        import threading
+        from six.moves import queue
+
+        self._stream = stream
+        self._queue = queue.Queue(blocks)
+        self._full = queue.Full
+        self._block = b''
+        self._offset = 0
+        self._error = None
+        self._eof = False
+        self._stopped = False
+        self._thread = threading.Thread(target=self._read_ahead, args=(block_size,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _read_ahead(self, block_size):
+        try:
+            while True:
+                block = self._stream.read(block_size)
+                if not self._put(block) or not block:
+                    return
+        except Exception as e:
+            self._error = e
+            self._put(b'')
+
+    def _put(self, block):
+        # Gives up once the reader is closed, which stops reading from it
+        while not self._stopped:
+            try:
+                self._queue.put(block, timeout=0.1)
+                return True
+            except self._full:
+                pass
+        return False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self._offset == len(self._block):
+            if self._eof:
+                return 0
+            self._block = self._queue.get()
+            self._offset = 0
+            if not self._block:
+                self._eof = True
+                if self._error is not None:
+                    raise self._error
+                return 0
+        n = min(len(b), len(self._block) - self._offset)
+        b[:n] = self._block[self._offset:self._offset + n]
+        self._offset += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._stopped = True
+            self._thread.join()
+            self._stream.close()
+        io.RawIOBase.close(self)
+
+
+def _chunks(lines, chunk_size):
+    lines = iter(lines)
+    return iter(lambda: list(itertools.islice(lines, chunk_size)), [])
+
+
+def _line_tuples(lines, col, sep):
+    extract = _key_extractor(col, sep)
+    if extract is None:
+        return ((l,) for l in lines)
+    else:
+        return ((extract(l), l) for l in lines)
+
+
+def _key_extractor(col, sep):
+    """Compiles column spec `col` (an index, -1 for the whole line, or a list
+    of indices forming a composite key) into a function extracting the key
+    from a line. Lines are split only as far as the last needed column, and
+    the fields of composite keys are joined with `sep`."""
+    if col == -1:
+        return None
+    cols = col if isinstance(col, list) else [col]
+    if min(cols) >= 0:
+        maxsplit = max(cols) + 1
+        if len(cols) == 1:
+            return lambda l: l.split(sep, maxsplit)[col]
+        getter = operator.itemgetter(*cols)
+        return lambda l: sep.join(getter(l.split(sep, maxsplit)))
+    if len(cols) == 1:
+        return lambda l: l.split(sep)[col]
+    getter = operator.itemgetter(*cols)
+    return lambda l: sep.join(getter(l.split(sep)))
+
+
+def _format_tuples(lines, format, col, key, sep):
+    """Yields (key, record) or (record,) tuples from csv, tsv or jsonl
+    input. Multi-line quoted csv records are kept together."""
+    if format == 'jsonl':
+        if key is None:
+            return ((l,) for l in lines)
+        return _jsonl_tuples(lines, key.split(','), sep)
+    elif format in ('csv', 'tsv'):
+        return _csv_tuples(lines, col, '\t' if format == 'tsv' else sep)
+    else:
+        raise ValueError('Unknown format: %s' % format)
+
+
+def _csv_tuples(lines, col, delimiter):
+    import csv
+
+    raw = []
+
+    def _tracked():
+        for l in lines:
+            raw.append(l)
+            yield l
+
+    cols = col if isinstance(col, list) else [col]
+    getter = operator.itemgetter(*cols)
+    # The csv module of Python 2 takes a byte string delimiter
+    for fields in csv.reader(_tracked(), delimiter=str(delimiter)):
+        record = ''.join(raw)
+        del raw[:]
+        if col == -1:
+            yield (record,)
+        elif len(cols) == 1:
+            yield (getter(fields), record)
+        else:
+            yield (delimiter.join(getter(fields)), record)
+
+
+def _jsonl_tuples(lines, paths, sep):
+    import json
+    import six
+
+    paths = [path.split('.') for path in paths]
+    for l in lines:
+        document = json.loads(l)
+        values = []
+        for path in paths:
+            value = document
+            for name in path:
+                value = value[name]
+            values.append(value if isinstance(value, six.text_type) else json.dumps(value, sort_keys=True))
+        yield (sep.join(values), l)
+
+
+def _strata_tuples(lines, col, strata_col, sep):
+    extract = _key_extractor(col, sep)
+    for l in lines:
+        stratum = l.split(sep)[strata_col].strip()
+        yield (l if extract is None else extract(l), stratum, l)
+
+
+def _read_rates(path):
+    rates = {}
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            stratum, rate = line.rsplit(None, 1)
+            rates[stratum] = float(rate)
+    return rates
+
+
+def _sample_chunk(lines, col, sep, rate, funcname, seed):
+    """Returns sampled `lines` joined into one string and their count."""
+    tuples = _line_tuples(lines, col, sep)
+    sampled = [l[-1] for l in sample_tuple(tuples, rate, 0, funcname, seed)]
+    return ''.join(sampled), len(sampled)
+
+
+def _maps_input(a):
+    """Returns whether --input can be hash-sampled as raw bytes through a
+    memory map, see `_sample_file()`."""
+    live = a.line_buffered or a.flush_lines or a.flush_interval
+    return bool(
+        a.input and _compression(a.input) is None and a.method == 'hash' and a.strata_col is None and
+        a.format == 'plain' and a.jobs == 1 and not live
+    )
+
+
+def _sample_file(f, write, a, block_size=1 << 22):
+    """Hash-sample the lines of file `f` through a read-only memory map.
+
+    Lines and keys are located on raw bytes, blocks of about `block_size`
+    bytes at a time, and the selected lines of each block are passed to
+    `write` as one bytes object without ever being decoded. Lines end at
+    b'\\n' only, as on standard input, so keys are the same bytes the text
+    path hashes once they are encoded to UTF-8.
+    """
+    import mmap
+
+    if os.fstat(f.fileno()).st_size == 0:
+        return
+    func = _hash_with_seed(a.hash, a.seed or 'DEFAULT_SEED')
+    batch = _batch_hash_with_seed(a.hash, a.seed or 'DEFAULT_SEED')
+    int_rate = _rate2int(a.rate, a.hash)
+    sep = a.sep.encode('utf-8')
+    if batch is None or isinstance(a.col, list) or a.col < -1 or len(sep) != 1 or sep == b'\n':
+        # Keys which are not a slice of the line are extracted line by line
+        sample = functools.partial(_sample_block_lines, func=func, col=a.col, sep=sep, int_rate=int_rate)
+    else:
+        sample = functools.partial(_sample_block, batch=batch, col=a.col, sep=sep, int_rate=int_rate)
+
+    buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        start = 0
+        while start < len(buf):
+            end = buf.find(b'\n', start + block_size - 1) + 1 or len(buf)
+            data, lines, selected = sample(buf[start:end])
+            write(data)
+            if a.stats is not None:
+                a.stats.rows_in += lines
+                a.stats.rows_out += selected
+            start = end
+    finally:
+        buf.close()
+
+
+def _sample_block_lines(block, func, col, sep, int_rate):
+    # Returns the selected lines of bytes `block`, the number of lines and
+    # the number of selected lines
+    extract = _key_extractor(col, sep)
+    selected = []
+    n = 0
+    for n, l in enumerate(io.BytesIO(block), 1):
+        if func(l if extract is None else extract(l)) < int_rate:
+            selected.append(l)
+    return b''.join(selected), n, len(selected)
+
+
+def _sample_block(block, batch, col, sep, int_rate):
+    # Same as _sample_block_lines(), with lines and keys located by NumPy
+    # and keys hashed in place by the batch hash function
+    import numpy
+
+    raw = numpy.frombuffer(block, numpy.uint8)
+    ends = numpy.flatnonzero(raw == ord(b'\n')) + 1
+    if not len(ends) or ends[-1] != len(raw):
+        ends = numpy.append(ends, len(raw))
+    starts = numpy.concatenate(([0], ends[:-1]))
+
+    if col == -1:
+        hashes = batch(block, numpy.concatenate(([0], ends)))
+    else:
+        key_starts, key_ends = _field_ranges(raw, starts, ends, col, sep)
+        # Keys are hashed together with the gaps between them, which are
+        # then dropped
+        offsets = numpy.empty(2 * len(starts), numpy.int64)
+        offsets[0::2] = key_starts
+        offsets[1::2] = key_ends
+        hashes = batch(block, offsets)[0::2]
+
+    selected = hashes < int_rate
+    data = raw[numpy.repeat(selected, ends - starts)].tobytes()
+    return data, len(starts), int(selected.sum())
+
+
+def _field_ranges(raw, starts, ends, col, sep):
+    # Start and end of field `col` of every line, split by the single byte
+    # `sep` as `_key_extractor()` splits it. The last field of a line keeps
+    # its line end.
+    import numpy
+
+    seps = numpy.flatnonzero(raw == ord(sep))
+    first = numpy.searchsorted(seps, starts)
+    counts = numpy.searchsorted(seps, ends) - first
+    if (counts < col).any():
+        raise IndexError('list index out of range')
+    if col == 0:
+        key_starts = starts
+    else:
+        key_starts = seps[first + col - 1] + 1
+    last = counts == col
+    if last.all():
+        return key_starts, ends
+    key_ends = numpy.where(last, ends, seps[numpy.minimum(first + col, len(seps) - 1)])
+    return key_starts, key_ends
+
+
+def _parallel_sample(chunks, write, jobs, ordered, task_args):
+    """Hash-sample `chunks` of lines on a process pool.
+
+    At most two chunks per worker are in flight at any time so memory stays
+    bounded regardless of input size.
+    """
+    import multiprocessing
+
+    pool = multiprocessing.Pool(jobs or None)
+    try:
+        max_pending = 2 * (jobs or multiprocessing.cpu_count())
+        pending = collections.deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(_sample_chunk, (chunk,) + task_args))
+            if len(pending) >= max_pending:
+                write(_next_result(pending, ordered))
+        while pending:
+            write(_next_result(pending, ordered))
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _next_result(pending, ordered):
+    if ordered:
+        return pending.popleft().get()
+
+    while True:
+        for i, result in enumerate(pending):
+            if result.ready():
+                del pending[i]
+                return result.get()
+        pending[0].wait(0.001)
+
+
+def _rate_spec(value):
+    rates = [float(r) for r in value.split(',')]
+    return rates[0] if len(rates) == 1 else rates
+
+
+def _column_spec(value):
+    cols = [int(c) for c in value.split(',')]
+    return cols[0] if len(cols) == 1 else cols
 
 
 def parse_arguments(args):
+    import argparse
+    import six
+
     parser = argparse.ArgumentParser(description='Print sampled standard input')
     parser.add_argument(
-        '-r', '--rate', type=float, required=True,
-        help='sampling rate (in hash sampling mode) or reservior size (in reservior sampling mode)'
+        '-r', '--rate', type=_rate_spec, required=True,
+        help='sampling rate, or comma separated rates written to separate --output files '
+             '(in hash sampling mode) or reservior size (in reservior sampling mode)'
     )
     parser.add_argument(
         '-s', '--seed', type=str,
         help='seed for hash function (in hash sampling mode) or random seed (in reservior sampling mode)'
     )
-    parser.add_argument('-c', '--col', type=int, default=-1, help='column index (starts from 0)')
-    parser.add_argument('--method', type=str, default='hash', help='sampling method: hash (default) or reservoir')
-    parser.add_argument('--hash', type=str, default='xxhash32', help='hash function: xxhash32 (default) or spooky32')
+    parser.add_argument(
+        '-c', '--col', type=_column_spec, default=-1,
+        help='column index (starts from 0), or comma separated indices of a composite key'
+    )
+    parser.add_argument(
+        '--format', type=str, default='plain',
+        help='input format: plain (default, lines split by --sep), csv, tsv or jsonl'
+    )
+    parser.add_argument('--key', type=str, help='comma separated dotted paths of key fields (jsonl format)')
+    parser.add_argument(
+        '--method', type=str, default='hash',
+        help='sampling method: hash (default), reservoir or weighted-reservoir'
+    )
+    parser.add_argument(
+        '--hash', type=str, default='xxhash32',
+        help='hash function: %s (default: xxhash32)' % ', '.join(hash_functions())
+    )
     parser.add_argument('--sep', type=str, default=',', help='column separator')
+    parser.add_argument(
+        '--strata-col', type=int,
+        help='column index of strata for stratified hash sampling, which uses --rate for unlisted strata'
+    )
+    parser.add_argument(
+        '--strata-file', type=str,
+        help='file of "<stratum> <rate>" lines giving sampling rates per stratum (with --strata-col)'
+    )
+    parser.add_argument(
+        '--weight-col', type=int,
+        help='column index of weights (required in weighted reservoir sampling mode)'
+    )
     parser.add_argument('--order', action='store_true', help='preserve input order')
+    parser.add_argument(
+        '-i', '--input', type=str,
+        help='read from file instead of standard input; .gz, .bz2, .xz, .lz4 and .zst files are decompressed'
+    )
+    parser.add_argument(
+        '-o', '--output', type=str,
+        help='write to file instead of standard output; {rate} in the file name is replaced by '
+             'the rate, which gives one file per rate with several rates'
+    )
+    parser.add_argument(
+        '--compress-level', type=int,
+        help='compression level of --output files ending in .gz, .bz2, .xz, .lz4 or .zst'
+    )
+    parser.add_argument('--buffer-size', type=int, default=65536, help='output buffer size in characters')
+    parser.add_argument('--flush-lines', type=int, default=0, help='flush output after this many lines')
+    parser.add_argument('--flush-interval', type=float, default=0, help='flush output every this many seconds')
+    parser.add_argument(
+        '--line-buffered', action='store_true',
+        help='write every line as soon as it is sampled (for interactive use)'
+    )
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=1,
+        help='number of worker processes in hash sampling mode (0 to use all CPUs)'
+    )
+    parser.add_argument(
+        '--chunk-size', type=int, default=10000,
+        help='lines read and sampled at a time (and sent to a worker process with --jobs)'
+    )
+    parser.add_argument(
+        '--stats', action='store_true',
+        help='write line counts and timings as JSON to standard error on exit and on SIGUSR1'
+    )
+    parser.add_argument(
+        '--unordered', action='store_true',
+        help='write chunks as soon as they are ready instead of in input order (with --jobs)'
+    )
 
     argdict = parser.parse_args(args)
+    if argdict.method == 'weighted-reservoir' and argdict.weight_col is None:
+        parser.error('--weight-col is required by --method=weighted-reservoir')
+    if isinstance(argdict.rate, list):
+        if argdict.method != 'hash' or argdict.strata_col is not None:
+            parser.error('several --rate values are only supported by --method=hash without --strata-col')
+        if not argdict.output or '{rate}' not in argdict.output:
+            parser.error('several --rate values need an --output template containing {rate}')
     argdict.sep = six.u(argdict.sep)
     return argdict
 
 
-def sample_tuple(s, rate, col, funcname='xxhash32', seed='DEFAULT_SEED'):
+def sample_tuple(s, rate, col, funcname='xxhash32', seed='DEFAULT_SEED', stats=None):
     """Sample tuples in given stream `s`.
 
     Performs hash-based sampling with given sampling `rate` by applying a hash
@@ -92,14 +898,26 @@ def sample_tuple(s, rate, col, funcname='xxhash32', seed='DEFAULT_SEED'):
     :param col: index of column to be hashed
     :param funcname: name of hash function: xxhash32 (default), spooky
     :param seed: seed for hash function
+    :param stats: optional :class:`Stats` to count rows in
     :return: sampled stream of tuples
     """
     func = _hash_with_seed(funcname, seed)
-    int_rate = int(rate * 0xFFFFFFFF)
+    int_rate = _rate2int(rate, funcname)
+    if stats is not None:
+        stats.rate = rate
+        return _sample_counted(s, int_rate, stats.profiled(func), col, stats)
     return (l for l in s if func(l[col]) < int_rate)
 
 
-def sample_line(s, rate, funcname='xxhash32', seed='DEFAULT_SEED'):
+def _sample_counted(s, int_rate, func, col, stats):
+    for l in s:
+        stats.rows_in += 1
+        if func(l[col]) < int_rate:
+            stats.rows_out += 1
+            yield l
+
+
+def sample_line(s, rate, funcname='xxhash32', seed='DEFAULT_SEED', stats=None):
     """Sample strings in given stream `s`.
 
     The function expects strings instead of tuples, except for that the
@@ -109,111 +927,1028 @@ def sample_line(s, rate, funcname='xxhash32', seed='DEFAULT_SEED'):
     :param rate: sampling rate from 0.0 to 1.0
     :param funcname: name of hash function: xxhash32 (default), spooky
     :param seed: seed for hash function
+    :param stats: optional :class:`Stats` to count lines in
     :return: sample stream of strings
     """
     tuples = ((l,) for l in s)
     return (
-        l[-1] for l in sample_tuple(tuples, rate, 0, funcname, seed)
+        l[-1] for l in sample_tuple(tuples, rate, 0, funcname, seed, stats)
     )
 
 
-def partition_tuple(s, ratios, col, funcname='xxhash32', seed='DEFAULT_SEED'):
-    """Partition a stream of tuples into two or more streams based
-    on hash value of specified column."""
-    func = _hash_with_seed(funcname, seed)
-    ranges = _ratios2ranges(ratios)
+def sample_stratified(s, rates, col, strata_col, funcname='xxhash32', seed='DEFAULT_SEED', default_rate=0.0):
+    """Sample tuples in given stream `s` with a different rate per stratum.
 
-    tees = itertools.tee(s, len(ratios))
+    Works like `sample_tuple()` except that the sampling rate of each tuple
+    depends on the value of column `strata_col`. `rates` is either a dict
+    from stratum to rate (strata not in it are sampled at `default_rate`) or
+    a function taking a stratum and returning its rate. Rates are converted
+    to hash thresholds once per stratum, and every tuple is hashed once:
 
-    def _create_generator(stream, low, high):
-        return (l for l in stream if low <= func(l[col]) < high)
+    >>> logs = (
+    ...     # user id, status
+    ...     ('alan', 500),
+    ...     ('brad', 200),
+    ...     ('cate', 200),
+    ...     ('daan', 404),
+    ... )
+    >>> list(sample_stratified(logs, {500: 1.0, 200: 0.5}, 0, 1))
+    [('alan', 500), ('cate', 200)]
 
-    return [
-        _create_generator(tee, low, high)
-        for tee, (_, low, high) in zip(tees, ranges)
-    ]
+    :param s: stream of tuples
+    :param rates: dict or function mapping a stratum to a sampling rate
+    :param col: index of column to be hashed
+    :param strata_col: index of column holding strata
+    :param funcname: name of hash function: xxhash32 (default), spooky
+    :param seed: seed for hash function
+    :param default_rate: sampling rate of strata missing from `rates` dict
+    :return: sampled stream of tuples
+    """
+    func = _hash_with_seed(funcname, seed)
+    if callable(rates):
+        rate_for = rates
+    else:
+        rate_for = lambda stratum: rates.get(stratum, default_rate)
+    thresholds = _ThresholdTable(rate_for, _max_hash(funcname))
+    return (l for l in s if func(l[col]) < thresholds[l[strata_col]])
 
 
-def partition_line(s, ratios, funcname='xxhash32', seed='DEFAULT_SEED'):
-    """Partition a stream of lines into two or more streams based
-    on hash value."""
-    tuples = ((l,) for l in s)
-    return (
-        (l[-1] for l in stream)
-        for stream in partition_tuple(tuples, ratios, 0, funcname, seed)
-    )
+class _ThresholdTable(dict):
+    """Maps strata to hash thresholds, computing each one on first use."""
+    def __init__(self, rate_for, max_hash):
+        dict.__init__(self)
+        self._rate_for = rate_for
+        self._max_hash = max_hash
 
+    def __missing__(self, stratum):
+        int_rate = self[stratum] = int(self._rate_for(stratum) * self._max_hash)
+        return int_rate
 
-def reservoir(s, size, seed=None, keep_order=False):
-    """Perform reservoir sampling.
 
-    >>> logs = (
-    ...     'alan',
-    ...     'brad',
-    ...     'cate',
-    ...     'daan',
-    ... )
-    >>> samples = reservoir(logs, 2)
-    >>> len(samples), len(set(samples))
-    (2, 2)
-    >>> set(samples).issubset(set(logs))
-    True
+def sample_batch(keys, rate, funcname='xxhash32', seed='DEFAULT_SEED', offsets=None, indices=False):
+    """Sample a batch of keys in a single call.
 
-    :param s: stream of anything
-    :param size: sample size
-    :param seed: optional seed (any hashable object)
-    :param keep_order: force elements in sample to respect input order
-    :return: sampled list
-    """
-    if seed is not None:
-        random.seed(seed)
+    Returns the same decisions as `sample_tuple()` would make for each key:
 
-    buckets = []
-    s = iter(s)
+    >>> sample_batch(['alan', 'brad', 'cate', 'daan'], 0.5)
+    [False, False, True, True]
+    >>> sample_batch(['alan', 'brad', 'cate', 'daan'], 0.5, indices=True)
+    [2, 3]
 
-    # 1. Initial phase to fill reservoir
-    k = 0
-    try:
-        for i in range(size):
-            buckets.append((k, next(s)))
-            k += 1
-    except StopIteration:
-        return [value for _, value in buckets]
+    `keys` can be a list of strs (or bytes), a NumPy array of strs/bytes, or
+    a contiguous bytes buffer together with Arrow-style `offsets` where the
+    i-th key is ``keys[offsets[i]:offsets[i + 1]]``:
 
-    # 2. Probabilistic update
-    for l in s:
-        position = random.randint(0, k)
-        if position < size:
-            buckets[position] = (k, l)
-        k += 1
+    >>> sample_batch(b'alanbradcatedaan', 0.5, offsets=[0, 4, 8, 12, 16])
+    [False, False, True, True]
 
-    if keep_order:
-        buckets = sorted(buckets, key=lambda x: x[0])
+    With NumPy installed, the default xxhash32 hashes the whole batch with
+    array operations, several times faster than `sample_tuple()`; a bytes
+    buffer with `offsets` (e.g. the buffers of an Arrow string array) is
+    hashed in place and is the fastest input. Other built-in hash functions
+    hash one key per call unless a `batch_factory` is registered for them
+    (see `register_hash()`).
 
-    return [e[1] for e in buckets]
+    :param keys: sequence of keys or a bytes-like buffer (see `offsets`)
+    :param rate: sampling rate from 0.0 to 1.0
+    :param funcname: name of hash function: xxhash32 (default), spooky
+    :param seed: seed for hash function
+    :param offsets: optional list of n + 1 offsets into buffer `keys`
+    :param indices: return indices of sampled keys instead of a boolean mask
+    :return: list of booleans, or list of indices if `indices` is set
+    """
+    func = _hash_with_seed(funcname, seed)
+    batch = _batch_hash_with_seed(funcname, seed)
+    int_rate = _rate2int(rate, funcname)
+    return _sample_many(func, keys, int_rate, offsets, indices, batch)
 
 
-def _hash_with_seed(funcname, seed):
-    seed = xxhash.xxh32(seed).intdigest()
+def sample_frame(df, rate, key, funcname='xxhash32', seed='DEFAULT_SEED'):
+    """Sample rows of a data frame by hash value of its `key` column.
 
-    xxh32 = xxhash.xxh32
-    spooky32 = spooky.hash32
+    Works on pyarrow Tables and RecordBatches, pandas DataFrames and polars
+    DataFrames, and returns a frame of the same kind holding the rows
+    `sample_tuple()` would select with the same seed, in the same order.
 
-    if funcname == 'xxhash32':
-        return lambda x: xxh32(x, seed=seed).intdigest()
-    elif funcname == 'spooky32':
-        return lambda x: spooky32(x, seed=seed)
+    Keys are never turned into rows: string columns backed by Arrow are
+    hashed straight from their data and offsets buffers (see
+    `sample_batch()`) and the selected rows are taken from the frame in one
+    call. Keys of other types are hashed as their Python ``str()``, so a
+    value selects the same rows whichever kind of frame holds it. Null keys
+    are rejected.
+
+    :param df: pyarrow Table or RecordBatch, pandas or polars DataFrame
+    :param rate: sampling rate from 0.0 to 1.0
+    :param key: name or position of the key column
+    :param funcname: name of hash function: xxhash32 (default), spooky
+    :param seed: seed for hash function
+    :return: sampled frame
+    """
+    func = _hash_with_seed(funcname, seed)
+    batch = _batch_hash_with_seed(funcname, seed)
+    int_rate = _rate2int(rate, funcname)
+
+    indices = []
+    start = 0
+    for keys, offsets, n in _frame_key_chunks(df, key):
+        indices.extend(start + i for i in _sample_many(func, keys, int_rate, offsets, True, batch))
+        start += n
+    return _take_rows(df, indices)
+
+
+def _frame_key_chunks(df, key):
+    """Yields (keys, offsets, number of keys) for every chunk of the key
+    column of `df`, to be hashed by `_hash_many()`."""
+    module = type(df).__module__.split('.')[0]
+    if module == 'pyarrow':
+        column = df.column(key)
+    elif module == 'pandas':
+        column = df.iloc[:, key] if isinstance(key, int) and key not in df.columns else df[key]
+        if not hasattr(column.array, '__arrow_array__'):
+            if column.isna().any():
+                raise ValueError('Key column contains nulls')
+            keys = _key_strings(column.tolist())
+            yield keys, None, len(keys)
+            return
+        import pyarrow
+
+        column = pyarrow.array(column)
+    elif module == 'polars':
+        column = df.get_column(key) if not isinstance(key, int) else df.to_series(key)
+        try:
+            column = column.to_arrow()
+        except ImportError:
+            if column.null_count():
+                raise ValueError('Key column contains nulls')
+            keys = _key_strings(column.to_list())
+            yield keys, None, len(keys)
+            return
+    else:
+        raise TypeError('Unsupported data frame: %r' % (type(df),))
+
+    for chunk in getattr(column, 'chunks', [column]):
+        yield _arrow_key_buffers(chunk)
+
+
+def _arrow_key_buffers(chunk):
+    import pyarrow
+
+    if chunk.null_count:
+        raise ValueError('Key column contains nulls')
+    types = pyarrow.types
+    if types.is_dictionary(chunk.type):
+        chunk = chunk.dictionary_decode()
+    if not (types.is_string(chunk.type) or types.is_binary(chunk.type) or
+            types.is_large_string(chunk.type) or types.is_large_binary(chunk.type)):
+        # Arrow casts format values differently from Python (1.0 as '1')
+        keys = _key_strings(chunk.to_pylist())
+        return keys, None, len(keys)
+
+    large = types.is_large_string(chunk.type) or types.is_large_binary(chunk.type)
+    _, offsets, data = chunk.buffers()
+    # Sliced arrays share the buffers of the whole array
+    offsets = memoryview(offsets).cast('q' if large else 'i')[chunk.offset:chunk.offset + len(chunk) + 1]
+    return (b'' if data is None else data), offsets, len(chunk)
+
+
+def _key_strings(values):
+    import six
+
+    return [v if isinstance(v, (six.text_type, bytes)) else six.text_type(v) for v in values]
+
+
+def _take_rows(df, indices):
+    module = type(df).__module__.split('.')[0]
+    if module == 'pandas':
+        return df.iloc[indices]
+    if module == 'polars':
+        return df[indices]
+    import pyarrow
+
+    # An empty list would be typed null, which take() cannot handle
+    return df.take(pyarrow.array(indices, type=pyarrow.int64()))
+
+
+def partition_tuple(s, ratios, col, funcname='xxhash32', seed='DEFAULT_SEED', stats=None):
+    """Partition a stream of tuples into two or more streams based
+    on hash value of specified column.
+
+    Each tuple is hashed exactly once and handed to the stream it belongs to.
+    Tuples read ahead on behalf of one stream are buffered for the others, so
+    consume the streams evenly or use `partition_tuple_into()` to keep memory
+    bounded. Per-partition counts are kept in `stats` if given."""
+    assign = Assigner(_hash_with_seed(funcname, seed), ratios, _max_hash(funcname), stats=stats)
+    source = iter(s)
+    queues = [collections.deque() for _ in ratios]
+
+    def _create_generator(queue):
+        while True:
+            while queue:
+                yield queue.popleft()
+            for l in source:
+                queues[assign(l[col])].append(l)
+                if queue:
+                    break
+            else:
+                return
+
+    return [_create_generator(queue) for queue in queues]
+
+
+def partition_line(s, ratios, funcname='xxhash32', seed='DEFAULT_SEED', stats=None):
+    """Partition a stream of lines into two or more streams based
+    on hash value."""
+    tuples = ((l,) for l in s)
+    return (
+        (l[-1] for l in stream)
+        for stream in partition_tuple(tuples, ratios, 0, funcname, seed, stats)
+    )
+
+
+def partition_tuple_into(s, ratios, col, sinks, funcname='xxhash32', seed='DEFAULT_SEED', stats=None):
+    """Partition a stream of tuples by pushing each tuple into one of `sinks`.
+
+    Each tuple is hashed exactly once and nothing is buffered, so memory stays
+    bounded no matter how large the input is. A sink can be a callable or any
+    object with a ``put`` (queues), ``write`` (files) or ``append`` (lists)
+    method:
+
+    >>> logs = [('alan', 0), ('brad', 1), ('cate', 2), ('daan', 3)]
+    >>> train, test = [], []
+    >>> partition_tuple_into(logs, [0.5, 0.5], 0, [train, test])
+    [2, 2]
+    >>> train, test
+    ([('cate', 2), ('daan', 3)], [('alan', 0), ('brad', 1)])
+
+    :param s: stream of tuples
+    :param ratios: list of ratios whose sum is equal to 1.0
+    :param col: index of column to be hashed
+    :param sinks: one sink per ratio
+    :param funcname: name of hash function: xxhash32 (default), spooky
+    :param seed: seed for hash function
+    :param stats: optional :class:`Stats` to count tuples in
+    :return: number of tuples sent to each sink
+    """
+    assign = Assigner(_hash_with_seed(funcname, seed), ratios, _max_hash(funcname), stats=stats)
+    return _partition_into(s, assign, [_sink_func(sink) for sink in sinks], lambda l: l[col])
+
+
+def partition_line_into(s, ratios, sinks, funcname='xxhash32', seed='DEFAULT_SEED', stats=None):
+    """Partition a stream of lines by pushing each line into one of `sinks`.
+
+    The function expects strings instead of tuples, except for that the
+    function does the exactly same thing with `partition_tuple_into()`.
+
+    :param s: stream of strings
+    :param ratios: list of ratios whose sum is equal to 1.0
+    :param sinks: one sink per ratio
+    :param funcname: name of hash function: xxhash32 (default), spooky
+    :param seed: seed for hash function
+    :param stats: optional :class:`Stats` to count lines in
+    :return: number of lines sent to each sink
+    """
+    assign = Assigner(_hash_with_seed(funcname, seed), ratios, _max_hash(funcname), stats=stats)
+    return _partition_into(s, assign, [_sink_func(sink) for sink in sinks], None)
+
+
+def partition_frame(df, ratios, key, funcname='xxhash32', seed='DEFAULT_SEED'):
+    """Partition rows of a data frame by hash value of its `key` column.
+
+    Rows go to the same partitions as with `partition_tuple_into()` and the
+    same seed. The key column is read as in `sample_frame()`.
+
+    :param df: pyarrow Table or RecordBatch, pandas or polars DataFrame
+    :param ratios: list of ratios whose sum is equal to 1.0
+    :param key: name or position of the key column
+    :param funcname: name of hash function: xxhash32 (default), spooky
+    :param seed: seed for hash function
+    :return: list of frames, one per ratio
+    """
+    assign = Assigner(
+        _hash_with_seed(funcname, seed), ratios, _max_hash(funcname), _batch_hash_with_seed(funcname, seed)
+    )
+
+    partitions = [[] for _ in ratios]
+    start = 0
+    for keys, offsets, n in _frame_key_chunks(df, key):
+        for i, index in enumerate(assign.assign_many(keys, offsets), start):
+            partitions[index].append(i)
+        start += n
+    return [_take_rows(df, indices) for indices in partitions]
+
+
+def sample_tuple_tiers(s, rates, col, sinks, funcname='xxhash32', seed='DEFAULT_SEED'):
+    """Sample a stream of tuples at several rates at once.
+
+    Hash sampling is nested: a tuple sampled at a low rate is also sampled
+    at every higher rate. Each tuple is hashed once and pushed into the sink
+    of every rate it qualifies for, which replaces one pass per rate. Sinks
+    are the same as for `partition_tuple_into()`:
+
+    >>> logs = [('alan', 0), ('brad', 1), ('cate', 2), ('daan', 3)]
+    >>> half, whole = [], []
+    >>> sample_tuple_tiers(logs, [0.5, 1.0], 0, [half, whole])
+    [2, 4]
+    >>> half
+    [('cate', 2), ('daan', 3)]
+
+    :param s: stream of tuples
+    :param rates: list of sampling rates from 0.0 to 1.0
+    :param col: index of column to be hashed
+    :param sinks: one sink per rate
+    :param funcname: name of hash function: xxhash32 (default), spooky
+    :param seed: seed for hash function
+    :return: number of tuples sent to each sink
+    """
+    func = _hash_with_seed(funcname, seed)
+    return _sample_tiers(s, rates, [_sink_func(sink) for sink in sinks], lambda l: func(l[col]), funcname)
+
+
+def sample_line_tiers(s, rates, sinks, funcname='xxhash32', seed='DEFAULT_SEED'):
+    """Sample a stream of lines at several rates at once.
+
+    The function expects strings instead of tuples, except for that the
+    function does the exactly same thing with `sample_tuple_tiers()`.
+
+    :param s: stream of strings
+    :param rates: list of sampling rates from 0.0 to 1.0
+    :param sinks: one sink per rate
+    :param funcname: name of hash function: xxhash32 (default), spooky
+    :param seed: seed for hash function
+    :return: number of lines sent to each sink
+    """
+    func = _hash_with_seed(funcname, seed)
+    return _sample_tiers(s, rates, [_sink_func(sink) for sink in sinks], func, funcname)
+
+
+def _sample_tiers(s, rates, sinks, hash_row, funcname):
+    max_hash = _max_hash(funcname)
+    # Tiers from the highest threshold down: a row qualifies for a prefix
+    order = sorted(range(len(rates)), key=lambda i: -rates[i])
+    ascending = [int(rates[i] * max_hash) for i in reversed(order)]
+    ordered_sinks = [sinks[i] for i in order]
+    n = len(rates)
+
+    counts = [0] * n
+    for l in s:
+        qualified = n - bisect.bisect_right(ascending, hash_row(l))
+        for i in range(qualified):
+            ordered_sinks[i](l)
+            counts[order[i]] += 1
+    return counts
+
+
+def _partition_into(s, assign, sinks, key):
+    counts = [0] * len(sinks)
+    for l in s:
+        index = assign(l if key is None else key(l))
+        sinks[index](l)
+        counts[index] += 1
+    return counts
+
+
+def _sink_func(sink):
+    if callable(sink):
+        return sink
+    for name in ('put', 'write', 'append'):
+        func = getattr(sink, name, None)
+        if func is not None:
+            return func
+    raise TypeError('Unsupported sink: %r' % (sink,))
+
+
+def reservoir(s, size, seed=None, keep_order=False, algorithm='R'):
+    """Perform reservoir sampling.
+
+    >>> logs = (
+    ...     'alan',
+    ...     'brad',
+    ...     'cate',
+    ...     'daan',
+    ... )
+    >>> samples = reservoir(logs, 2)
+    >>> len(samples), len(set(samples))
+    (2, 2)
+    >>> set(samples).issubset(set(logs))
+    True
+
+    Algorithm 'R' (default) draws a random number for every element. With
+    algorithm 'L' the number of elements to skip until the next replacement
+    is drawn from a geometric distribution instead, so only O(k log(n/k))
+    random numbers are drawn and skipped elements are never looked at.
+
+    With a `seed`, random numbers come from a private ``random.Random(seed)``
+    and the global state of the `random` module is left alone, so seeded
+    reservoirs can run side by side in threads or interleaved generators.
+    A given seed always yields the same sample, which is also the sample
+    earlier versions produced after calling ``random.seed(seed)``.
+    Unseeded reservoirs draw from the shared generator of the `random`
+    module.
+
+    :param s: stream of anything
+    :param size: sample size
+    :param seed: optional seed (any hashable object)
+    :param keep_order: force elements in sample to respect input order
+    :param algorithm: 'R' (default) or 'L'
+    :return: sampled list
+    """
+    if algorithm not in ('R', 'L'):
+        raise ValueError('Unknown algorithm: %s' % algorithm)
+
+    rand = _private_random(seed)
+
+    buckets = []
+    s = iter(s)
+
+    # 1. Initial phase to fill reservoir
+    k = 0
+    try:
+        for i in range(size):
+            buckets.append((k, next(s)))
+            k += 1
+    except StopIteration:
+        return [value for _, value in buckets]
+
+    # 2. Probabilistic update
+    if algorithm == 'L':
+        _skip_update(s, buckets, size, k, rand)
     else:
+        randint = rand.randint
+        for l in s:
+            position = randint(0, k)
+            if position < size:
+                buckets[position] = (k, l)
+            k += 1
+
+    if keep_order:
+        buckets = sorted(buckets, key=lambda x: x[0])
+
+    return [e[1] for e in buckets]
+
+
+def weighted_reservoir(s, size, col, seed=None, keep_order=False):
+    """Perform weighted reservoir sampling over a stream of tuples.
+
+    Each tuple is sampled with a probability proportional to the weight in
+    column `col`, using A-Res with exponential jumps (A-ExpJ, Efraimidis and
+    Spirakis, 2006): random numbers are only drawn for tuples entering the
+    reservoir, so their number grows logarithmically with the stream size.
+    Tuples with zero weight are never sampled. Like `reservoir()`, it draws
+    random numbers from a private ``random.Random(seed)`` if seeded.
+
+    >>> logs = (
+    ...     # user id, bytes transferred
+    ...     ('alan', 0),
+    ...     ('brad', 10),
+    ...     ('cate', 3),
+    ... )
+    >>> sorted(weighted_reservoir(logs, 2, 1))
+    [('brad', 10), ('cate', 3)]
+
+    :param s: stream of tuples
+    :param size: sample size
+    :param col: index of column holding weights
+    :param seed: optional seed (any hashable object)
+    :param keep_order: force elements in sample to respect input order
+    :return: sampled list
+    """
+    if size <= 0:
+        return []
+    rand = _private_random(seed)
+
+    heap = []
+    s = iter(s)
+    k = 0
+
+    # 1. Initial phase to fill reservoir; keys are log(u) / weight so that
+    # large weights win without running into floating point underflow
+    for l in s:
+        if len(heap) >= size:
+            heap.append((None, k, l))
+            break
+        weight = _weight(l[col])
+        if weight:
+            heap.append((math.log(_random_nonzero(rand)) / weight, k, l))
+        k += 1
+    pending = heap.pop() if len(heap) > size else None
+    heapq.heapify(heap)
+
+    # 2. Exponential jumps over the total weight that can be skipped
+    if pending is not None:
+        threshold = heap[0][0]
+        jump = _exponential_jump(threshold, rand)
+        for l in itertools.chain((pending[2],), s):
+            weight = _weight(l[col])
+            jump -= weight
+            if jump <= 0 and weight:
+                low = math.exp(threshold * weight)
+                key = math.log(low + (1.0 - low) * _random_nonzero(rand)) / weight
+                heapq.heapreplace(heap, (key, k, l))
+                threshold = heap[0][0]
+                jump = _exponential_jump(threshold, rand)
+            k += 1
+
+    if keep_order:
+        heap.sort(key=lambda x: x[1])
+
+    return [e[2] for e in heap]
+
+
+def _exponential_jump(threshold, rand):
+    if not threshold:
+        # Nothing can beat the largest possible key any more
+        return float('inf')
+    return math.log(_random_nonzero(rand)) / threshold
+
+
+def _weight(value):
+    weight = float(value)
+    if weight < 0:
+        raise ValueError('Negative weight: %r' % (value,))
+    return weight
+
+
+def _skip_update(s, buckets, size, k, rand):
+    """Algorithm L (Li, 1994): jump straight to the next element that enters
+    the reservoir."""
+    if size <= 0:
+        return
+
+    w = math.exp(math.log(_random_nonzero(rand)) / size)
+    while True:
+        skip = math.floor(math.log(_random_nonzero(rand)) / math.log1p(-w))
+        skip = int(min(skip, sys.maxsize - 1))
+        for l in itertools.islice(s, skip, skip + 1):
+            k += skip
+            buckets[rand.randrange(size)] = (k, l)
+            k += 1
+            break
+        else:
+            return
+        w *= math.exp(math.log(_random_nonzero(rand)) / size)
+
+
+def _private_random(seed):
+    import random
+
+    if seed is None:
+        # Unseeded samples need no reproducible stream, and seeding a new
+        # generator from the OS costs more than sampling a short list, so
+        # the functions of the module (sharing its generator) are used
+        return random
+    return random.Random(seed)
+
+
+def _random_nonzero(rand):
+    return rand.random() or sys.float_info.min
+
+
+_HashBackend = collections.namedtuple('_HashBackend', ['factory', 'bits', 'batch_factory'])
+_hash_backends = {}
+
+
+def register_hash(name, factory, bits=32, batch_factory=None):
+    """Register a hash function under `name`, making it available to every
+    sampling function and to the command-line interface.
+
+    `factory` is called with an integer seed derived from the user supplied
+    seed and must return a function which maps a str or bytes-like object to
+    an integer from 0 to ``2 ** bits - 1``. Sampling thresholds use the full
+    `bits` width, so wider hashes give finer control over very low rates.
+
+    `batch_factory`, if given, is called the same way and must return a
+    function taking `keys` and `offsets` as `sample_batch()` accepts them
+    (`offsets` is None for a list of keys) and returning a list or NumPy
+    array of hash values, exactly matching the scalar function. Batch APIs
+    such as `sample_batch()` use it. It may return None when the batch
+    implementation is unavailable, e.g. for lack of NumPy.
+
+    :param name: name of hash function
+    :param factory: function taking a seed and returning a hash function
+    :param bits: width of hash values
+    :param batch_factory: optional function taking a seed and returning a
+        batch hash function
+    """
+    _hash_backends[name] = _HashBackend(factory, bits, batch_factory)
+
+
+def hash_functions():
+    """Returns names of registered hash functions.
+
+    Some of them need optional dependencies (or newer versions of them) and
+    raise ValueError when used without.
+    """
+    return sorted(_hash_backends)
+
+
+def fastest_hash(bits=32, keys=None, repeat=3):
+    """Returns the name of the fastest usable hash function which is at least
+    `bits` wide, timed on `keys` (a list of short strs by default).
+
+    The default hash function stays xxhash32 so that results are reproducible
+    everywhere: run this once on the target machine and pass its result as
+    `funcname` explicitly.
+
+    :param bits: minimum width of hash values
+    :param keys: list of sample keys to hash
+    :param repeat: number of timing runs per hash function
+    :return: name of hash function
+    """
+    import timeit
+
+    if keys is None:
+        keys = ['user%d' % i for i in range(10000)]
+
+    timings = []
+    for name in hash_functions():
+        if _hash_backends[name].bits < bits:
+            continue
+        try:
+            func = _hash_with_seed(name, 'DEFAULT_SEED')
+            func(keys[0])
+        except Exception:
+            continue
+        timer = timeit.Timer(lambda: list(map(func, keys)))
+        timings.append((min(timer.repeat(repeat, 1)), name))
+
+    if not timings:
+        raise ValueError('No usable hash function with at least %d bits' % bits)
+    return min(timings)[1]
+
+
+def _backend(funcname):
+    try:
+        return _hash_backends[funcname]
+    except KeyError:
         raise ValueError('Unknown function name: %s' % funcname)
 
 
-def _ratios2ranges(ratios):
-    dart_ticks = [0] + [sum(ratios[:i + 1]) * 0xFFFFFFFF for i in range(len(ratios))]
-    dart_ticks[-1] = 0xFFFFFFFF
+def _hash_with_seed(funcname, seed):
+    return _backend(funcname).factory(_derive_seed(seed))
+
+
+def _batch_hash_with_seed(funcname, seed):
+    batch_factory = _backend(funcname).batch_factory
+    if batch_factory is None:
+        return None
+    return batch_factory(_derive_seed(seed))
+
+
+def _derive_seed(seed):
+    import xxhash
+
+    return xxhash.xxh32(seed).intdigest()
+
+
+def _max_hash(funcname):
+    return (1 << _backend(funcname).bits) - 1
+
+
+def _rate2int(rate, funcname):
+    return int(rate * _max_hash(funcname))
+
+
+def _require(module, name, requirement):
+    func = getattr(module, name, None)
+    if func is None:
+        raise ValueError('Hash function needs %s' % requirement)
+    return func
+
+
+def _xxhash32(seed):
+    import xxhash
+
+    # One-shot digest avoids creating a hasher object per call
+    xxh32_intdigest = getattr(xxhash, 'xxh32_intdigest', None)
+    if xxh32_intdigest is not None:
+        return functools.partial(xxh32_intdigest, seed=seed)
+    xxh32 = xxhash.xxh32
+    return lambda x: xxh32(x, seed=seed).intdigest()
+
+
+def _xxhash32_batch(seed):
+    try:
+        import numpy
+    except ImportError:
+        # Keys are hashed one by one without NumPy
+        return None
+
+    def batch(keys, offsets=None):
+        if offsets is None:
+            keys, offsets = _key_buffer(keys)
+        return _xxh32_many(keys, numpy.array(offsets, numpy.int64), seed)
+
+    return batch
+
+
+_XXH32_PRIMES = (2654435761, 2246822519, 3266489917, 668265263, 374761393)
+
+
+def _xxh32_many(data, offsets, seed):
+    """Returns XXH32 values of the keys in buffer `data` delimited by the
+    NumPy array `offsets` as a NumPy array, equal to
+    ``xxhash.xxh32_intdigest()`` of each key.
+
+    Keys are grouped by length and by alignment of their first byte, so each
+    round of the hash is a few array operations over a whole group.
+    """
+    import numpy
+
+    raw = numpy.frombuffer(data, numpy.uint8)
+    starts = offsets[:-1]
+    lengths = offsets[1:] - starts
+    if not len(starts):
+        return numpy.zeros(0, numpy.uint32)
+    # Little-endian words starting at byte 0, 1, 2 and 3 of the buffer
+    words = [raw[r:r + 4 * (max(len(raw) - r, 0) // 4)].view('<u4') for r in range(4)]
+
+    groups = lengths * 4 + (starts & 3)
+    if groups.max() <= 0xFFFF:
+        # NumPy sorts 16-bit integers by radix sort
+        groups = groups.astype(numpy.uint16)
+    order = numpy.argsort(groups, kind='stable')
+    groups = groups[order]
+    starts = starts[order]
+    bounds = [0] + (numpy.flatnonzero(numpy.diff(groups)) + 1).tolist() + [len(groups)]
+    hashes = numpy.empty(len(groups), numpy.uint32)
+    for low, high in zip(bounds, bounds[1:]):
+        length, alignment = divmod(int(groups[low]), 4)
+        group = starts[low:high]
+        hashes[low:high] = _xxh32_group(raw, words[alignment], group, (group - alignment) >> 2, length, seed)
+
+    result = numpy.empty(len(hashes), numpy.uint32)
+    result[order] = hashes
+    return result
+
+
+def _xxh32_group(raw, words, starts, word_starts, length, seed):
+    # XXH32 of `length`-byte keys at byte `starts`, whose i-th 4-byte lane
+    # is words[word_starts + i]
+    import numpy
+
+    uint32 = numpy.uint32
+    prime1, prime2, prime3, prime4, prime5 = (uint32(p) for p in _XXH32_PRIMES)
+
+    def rotl(x, r):
+        return (x << uint32(r)) | (x >> uint32(32 - r))
+
+    n = len(starts)
+    lane = 0
+    if length >= 16:
+        accs = [
+            numpy.full(n, (seed + p) & 0xFFFFFFFF, uint32)
+            for p in (_XXH32_PRIMES[0] + _XXH32_PRIMES[1], _XXH32_PRIMES[1], 0, -_XXH32_PRIMES[0])
+        ]
+        for _ in range(length // 16):
+            for i, acc in enumerate(accs):
+                acc += words[word_starts + lane] * prime2
+                accs[i] = rotl(acc, 13) * prime1
+                lane += 1
+        h = rotl(accs[0], 1) + rotl(accs[1], 7) + rotl(accs[2], 12) + rotl(accs[3], 18)
+    else:
+        h = numpy.full(n, (seed + _XXH32_PRIMES[4]) & 0xFFFFFFFF, uint32)
+    h += uint32(length & 0xFFFFFFFF)
+
+    while 4 * (lane + 1) <= length:
+        h = rotl(h + words[word_starts + lane] * prime3, 17) * prime4
+        lane += 1
+    for i in range(4 * lane, length):
+        h = rotl(h + raw[starts + i].astype(uint32) * prime5, 11) * prime1
+
+    h ^= h >> uint32(15)
+    h *= prime2
+    h ^= h >> uint32(13)
+    h *= prime3
+    h ^= h >> uint32(16)
+    return h
+
+
+def _key_buffer(keys):
+    """Returns a list of str or bytes `keys` as one UTF-8 buffer and the
+    NumPy array of offsets delimiting them."""
+    import numpy
+    import six
+
+    n = len(keys)
+    offsets = numpy.zeros(n + 1, numpy.int64)
+    try:
+        # Keys joined by NUL are encoded in one call and split by the
+        # positions of the separators, if no key contains NUL itself
+        raw = numpy.frombuffer(u'\0'.join(keys).encode('utf-8'), numpy.uint8)
+    except (TypeError, UnicodeError):
+        raw = None
+    if raw is not None:
+        separators = numpy.flatnonzero(raw == 0)
+        if len(separators) == max(n - 1, 0):
+            offsets[1:-1] = separators - numpy.arange(n - 1)
+            offsets[-1] = len(raw) - len(separators)
+            return raw[raw != 0], offsets
+
+    keys = [k.encode('utf-8') if isinstance(k, six.text_type) else memoryview(k).tobytes() for k in keys]
+    numpy.cumsum([len(k) for k in keys], out=offsets[1:])
+    return b''.join(keys), offsets
+
+
+def _xxhash64(seed):
+    import xxhash
+
+    xxh64_intdigest = getattr(xxhash, 'xxh64_intdigest', None)
+    if xxh64_intdigest is not None:
+        return functools.partial(xxh64_intdigest, seed=seed)
+    xxh64 = xxhash.xxh64
+    return lambda x: xxh64(x, seed=seed).intdigest()
+
+
+def _xxh3_64(seed):
+    import xxhash
+
+    return functools.partial(_require(xxhash, 'xxh3_64_intdigest', 'xxhash>=2.0'), seed=seed)
+
+
+def _xxh128(seed):
+    import xxhash
+
+    return functools.partial(_require(xxhash, 'xxh3_128_intdigest', 'xxhash>=2.0'), seed=seed)
+
+
+def _spooky32(seed):
+    import spooky
+
+    return functools.partial(spooky.hash32, seed=seed)
+
+
+def _spooky64(seed):
+    import spooky
+
+    return functools.partial(spooky.hash64, seed=seed)
+
+
+def _blake2b(seed):
+    import hashlib
+    import six
+
+    blake2b = _require(hashlib, 'blake2b', 'Python 3.6+')
+    key = struct.pack('<I', seed)
+
+    def func(data):
+        if isinstance(data, six.text_type):
+            data = data.encode('utf-8')
+        return int(blake2b(data, digest_size=8, key=key).hexdigest(), 16)
+
+    return func
+
+
+register_hash('xxhash32', _xxhash32, 32, _xxhash32_batch)
+register_hash('xxhash64', _xxhash64, 64)
+register_hash('xxh3_64', _xxh3_64, 64)
+register_hash('xxh128', _xxh128, 128)
+register_hash('spooky32', _spooky32, 32)
+register_hash('spooky64', _spooky64, 64)
+register_hash('blake2b', _blake2b, 64)
+
+
+def _hash_many(func, keys, offsets=None, batch=None):
+    if offsets is None and hasattr(keys, 'tolist'):
+        # NumPy arrays: convert once instead of boxing scalars one by one
+        keys = keys.tolist()
+    if batch is not None:
+        return batch(keys, offsets)
+    if offsets is not None:
+        if hasattr(offsets, 'tolist'):
+            offsets = offsets.tolist()
+        view = memoryview(keys)
+        # Slices are hashed as they are made: a list of a million views
+        # would keep the garbage collector busy
+        keys = (view[low:high] for low, high in zip(offsets, offsets[1:]))
+    return list(map(func, keys))
+
+
+def _sample_many(func, keys, int_rate, offsets=None, indices=False, batch=None):
+    hashes = _hash_many(func, keys, offsets, batch)
+    if hasattr(hashes, 'nonzero'):
+        # NumPy arrays from batch hash functions are compared in one call
+        selected = hashes < int_rate
+        return selected.nonzero()[0].tolist() if indices else selected.tolist()
+    if indices:
+        return [i for i, hashval in enumerate(hashes) if hashval < int_rate]
+    return [hashval < int_rate for hashval in hashes]
+
+
+def _hash_typecode(bits):
+    """Returns the smallest array typecode holding `bits`-bit hash values,
+    or None if hashes are wider than 64 bits."""
+    for typecode in ('I', 'L', 'Q'):
+        try:
+            if array(typecode).itemsize * 8 >= bits:
+                return typecode
+        except ValueError:
+            # 'Q' needs Python 3.3 or later
+            pass
+    return None
+
+
+def _array_tobytes(values):
+    # array.tobytes() is called tostring() before Python 3.2
+    return getattr(values, 'tobytes', getattr(values, 'tostring', None))()
+
+
+def _array_frombytes(values, data):
+    getattr(values, 'frombytes', getattr(values, 'fromstring', None))(data)
+
+
+def _ratios2ranges(ratios, max_hash=0xFFFFFFFF):
+    dart_ticks = [0] + [sum(ratios[:i + 1]) * max_hash for i in range(len(ratios))]
+    dart_ticks[-1] = max_hash
     ranges = [(i, dart_ticks[i], dart_ticks[i + 1]) for i in range(len(dart_ticks) - 1)]
     return ranges
 
 
+class Stats(object):
+    """Counters filled in by samplers and partitioners given as `stats`.
+
+    >>> stats = Stats()
+    >>> sampled = list(sample_line(['alan', 'brad', 'cate', 'daan'], 0.5, stats=stats))
+    >>> stats.rows_in, stats.rows_out, stats.keep_ratio()
+    (4, 2, 0.5)
+
+    Counters are plain attributes updated as rows go by, so they can be read
+    at any time, e.g. from a signal handler, while sampling is running.
+    Partitioners count rows per partition in `counts`. Functions called
+    without `stats` don't count anything and run at full speed.
+
+    With `profile_every` set to n, every n-th hash function call is timed and
+    ``seconds['hash']`` is extrapolated from those calls, which costs a
+    function call per row and two clock reads per n rows.
+    """
+    def __init__(self, profile_every=0):
+        """
+        :param profile_every: time every n-th hash function call (0 disables)
+        """
+        self.rows_in = 0
+        self.rows_out = 0
+        self.rate = None
+        self.counts = []
+        self.seconds = collections.defaultdict(float)
+        self.profile_every = profile_every
+
+    def keep_ratio(self):
+        """
+        Returns the ratio of rows kept, to be compared against `rate`.
+
+        :return: float, or None if no row went through yet
+        """
+        return self.rows_out / self.rows_in if self.rows_in else None
+
+    def as_dict(self):
+        """
+        :return: dict of all counters
+        """
+        stats = {
+            'rows_in': self.rows_in,
+            'rows_out': self.rows_out,
+            'rate': self.rate,
+            'keep_ratio': self.keep_ratio(),
+            'seconds': dict(self.seconds),
+        }
+        if self.counts:
+            stats['counts'] = list(self.counts)
+        return stats
+
+    def to_json(self):
+        """
+        :return: counters as a JSON object
+        """
+        import json
+
+        return json.dumps(self.as_dict(), sort_keys=True)
+
+    def profiled(self, func):
+        """
+        Wraps hash function `func` to time every `profile_every`-th call.
+
+        :param func: hash function
+        :return: `func` itself if profiling is disabled
+        """
+        every = self.profile_every
+        if not every:
+            return func
+        clock = _clock()
+        seconds = self.seconds
+        countdown = [every]
+
+        def profiled(key):
+            countdown[0] -= 1
+            if countdown[0]:
+                return func(key)
+            countdown[0] = every
+            start = clock()
+            hashval = func(key)
+            seconds['hash'] += (clock() - start) * every
+            return hashval
+
+        return profiled
+
+
 class HashSampler(object):
     """Class-based interface for hash sampling.
 
@@ -228,14 +1963,31 @@ class HashSampler(object):
     >>> sampler.should_sample('daan', rate)
     True
     """
-    def __init__(self, funcname='xxhash32', seed='DEFAULT_SEED'):
+    def __init__(self, funcname='xxhash32', seed='DEFAULT_SEED', cache_size=0):
         """
         Create an instance of HashSample
 
+        Set `cache_size` to remember hash values of up to that many recently
+        seen keys, which saves hashing hot keys again and again. Least
+        recently used keys are evicted first (approximated by CLOCK). Each
+        entry costs a dict slot, a list slot, 4 or 8 bytes for the hash
+        value (a Python int for hashes wider than 64 bits) and a reference
+        byte, plus the key object itself which the cache keeps alive. The
+        cache takes a lock per lookup, so a cached sampler can be shared
+        between threads.
+
         :param funcname: name of hash function: xxhash32 (default), spooky
         :param seed: seed for hash function
+        :param cache_size: number of hash values to memoize (0 disables)
         """
-        self._func = _hash_with_seed(funcname, seed)
+        self._hash = _hash_with_seed(funcname, seed)
+        self._cache = None
+        if cache_size > 0:
+            self._cache = _ClockCache(self._hash, cache_size, _hash_typecode(_backend(funcname).bits))
+        self._func = self._cache or self._hash
+        self._batch = None if self._cache else _batch_hash_with_seed(funcname, seed)
+        self._max_hash = _max_hash(funcname)
+        self._assigners = {}
 
     def should_sample(self, data, rate):
         """
@@ -244,21 +1996,47 @@ class HashSampler(object):
         :param data: any str to be hashed
         :param rate: sampling rate from 0.0 to 1.0
         """
-        int_rate = int(rate * 0xFFFFFFFF)
+        int_rate = int(rate * self._max_hash)
         return self._func(data) < int_rate
 
+    def should_sample_many(self, keys, rate, offsets=None, indices=False):
+        """
+        Checks a whole batch of keys at once. See :func:`sample_batch`.
+
+        :param keys: sequence of keys or a bytes-like buffer (see `offsets`)
+        :param rate: sampling rate from 0.0 to 1.0
+        :param offsets: optional list of n + 1 offsets into buffer `keys`
+        :param indices: return indices of sampled keys instead of a mask
+        """
+        int_rate = int(rate * self._max_hash)
+        # Buffer slices are never cached: they would pin the buffer in memory
+        func = self._hash if offsets is not None else self._func
+        return _sample_many(func, keys, int_rate, offsets, indices, self._batch)
+
+    def cache_info(self):
+        """
+        Reports hit and miss counters of the hash cache.
+
+        :return: a `CacheInfo` named tuple, or None if caching is disabled
+        """
+        if self._cache is None:
+            return None
+        return self._cache.info()
+
     def assign(self, data, ratios):
         """
         .. deprecated:: 0.6.0
            Use :func:`assign_for` instead.
         """
-        ranges = _ratios2ranges(ratios)
-        hashval = self._func(data)
-        for index, low, high in ranges:
-            if low <= hashval < high:
-                return index
+        key = tuple(ratios)
+        assigner = self._assigners.get(key)
+        if assigner is None:
+            if len(self._assigners) >= 64:
+                self._assigners.clear()
+            assigner = self._assigners[key] = self.assign_for(ratios)
+        return assigner(data)
 
-    def assign_for(self, ratios):
+    def assign_for(self, ratios, stats=None):
         """
         Returns a function takes a str and returns an integer index on given
         (curried) ratios.
@@ -269,19 +2047,854 @@ class HashSampler(object):
         You can use this method to assign users into several groups in order
         to perform A/B testing.
 
+        The returned :class:`Assigner` looks buckets up by binary search, so
+        it stays fast with hundreds of groups, and also offers
+        :meth:`Assigner.assign_many` for batches.
+
         :param ratios: list of sampling rates whose sum is equal to 1.0
+        :param stats: optional :class:`Stats` to count keys per group in
+        :return: an :class:`Assigner`
+        """
+        return Assigner(self._func, ratios, self._max_hash, self._batch, stats)
+
+
+CacheInfo = collections.namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+class _ClockCache(object):
+    """Memoizes `func` for at most `size` keys with CLOCK eviction. Hash
+    values are stored in an array of `typecode`, or a list if None.
+
+    The cache may be shared between threads: lookups and updates hold a lock,
+    and keys are hashed outside of it.
+    """
+    def __init__(self, func, size, typecode=None):
+        import threading
+
+        self._func = func
+        self._size = size
+        self._lock = threading.Lock()
+        self._slots = {}
+        self._keys = [None] * size
+        self._hashes = array(typecode, [0]) * size if typecode else [0] * size
+        self._referenced = bytearray(size)
+        self._hand = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, key):
+        with self._lock:
+            slot = self._slots.get(key)
+            if slot is not None:
+                self.hits += 1
+                self._referenced[slot] = 1
+                return self._hashes[slot]
+            self.misses += 1
+
+        hashval = self._func(key)
+
+        with self._lock:
+            slots = self._slots
+            if key in slots:
+                # Another thread stored the key while it was being hashed
+                return hashval
+            if len(slots) < self._size:
+                slot = len(slots)
+            else:
+                # Sweep the hand, giving referenced entries a second chance
+                referenced = self._referenced
+                slot = self._hand
+                while referenced[slot]:
+                    referenced[slot] = 0
+                    slot = (slot + 1) % self._size
+                self._hand = (slot + 1) % self._size
+                del slots[self._keys[slot]]
+
+            slots[key] = slot
+            self._keys[slot] = key
+            self._hashes[slot] = hashval
+        return hashval
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self._size, len(self._slots))
+
+
+class Assigner(object):
+    """Compiled mapping from data to group index, see
+    :meth:`HashSampler.assign_for`.
+
+    >>> assigner = HashSampler().assign_for([0.5, 0.5])
+    >>> [assigner(name) for name in ('alan', 'brad', 'cate', 'daan')]
+    [1, 1, 0, 0]
+    >>> assigner.assign_many(['alan', 'brad', 'cate', 'daan'])
+    array('B', [1, 1, 0, 0])
+    """
+    def __new__(cls, func, ratios, max_hash=0xFFFFFFFF, batch=None, stats=None):
+        # Counting lives in a subclass so that assigners without stats don't
+        # pay for it
+        if cls is Assigner and stats is not None:
+            cls = _CountingAssigner
+        return object.__new__(cls)
+
+    def __init__(self, func, ratios, max_hash=0xFFFFFFFF, batch=None, stats=None):
+        ranges = _ratios2ranges(ratios, max_hash)
+        # Upper bounds of every group but the last one, which also takes the
+        # maximum hash value
+        self._bounds = [high for _, _, high in ranges[:-1]]
+        self._func = func
+        self._batch = batch
+        self._typecode = 'B' if len(ranges) <= 0x100 else 'H' if len(ranges) <= 0x10000 else 'L'
+
+    def __call__(self, data):
+        """
+        :param data: any str to be hashed
         :return: an index
         """
-        ranges = _ratios2ranges(ratios)
+        return bisect.bisect_right(self._bounds, self._func(data))
+
+    def assign_many(self, keys, offsets=None):
+        """
+        Assigns a whole batch of keys at once.
+
+        :param keys: sequence of keys or a bytes-like buffer (see `offsets`)
+        :param offsets: optional list of n + 1 offsets into buffer `keys`
+        :return: array of indices
+        """
+        hashes = _hash_many(self._func, keys, offsets, self._batch)
+        result = array(self._typecode)
+        if hasattr(hashes, 'searchsorted'):
+            # NumPy arrays from batch hash functions are looked up in one call
+            import numpy
+
+            indices = numpy.array(self._bounds, hashes.dtype).searchsorted(hashes, 'right')
+            _array_frombytes(result, indices.astype(self._typecode).tobytes())
+            return result
+        result.extend(map(functools.partial(bisect.bisect_right, self._bounds), hashes))
+        return result
+
+
+class _CountingAssigner(Assigner):
+    """Assigner which counts keys per group in a :class:`Stats`."""
+    def __init__(self, func, ratios, max_hash=0xFFFFFFFF, batch=None, stats=None):
+        Assigner.__init__(self, stats.profiled(func), ratios, max_hash, batch)
+        stats.rate = list(ratios)
+        stats.counts.extend([0] * (len(ratios) - len(stats.counts)))
+        self._stats = stats
+
+    def __call__(self, data):
+        index = bisect.bisect_right(self._bounds, self._func(data))
+        stats = self._stats
+        stats.rows_in += 1
+        stats.rows_out += 1
+        stats.counts[index] += 1
+        return index
+
+    def assign_many(self, keys, offsets=None):
+        indices = Assigner.assign_many(self, keys, offsets)
+        stats = self._stats
+        stats.rows_in += len(indices)
+        stats.rows_out += len(indices)
+        for index, count in collections.Counter(indices).items():
+            stats.counts[index] += count
+        return indices
+
+
+class KeyIndex(object):
+    """Sorted set of key hashes which can be saved to a file and memory-mapped
+    by downstream jobs.
+
+    Build the index once while sampling, then test membership elsewhere
+    without knowing the sampling rate. Keys are looked up by hash using the
+    hash function and seed the index was built with; callers which already
+    have hash values (e.g. from a join key column hashed once) can use
+    :meth:`contains_hash` and skip hashing altogether:
+
+    >>> index = KeyIndex.build(['alan', 'brad', 'cate', 'daan'], rate=0.5)
+    >>> len(index), 'cate' in index, 'alan' in index
+    (2, True, False)
+
+    The file layout is a small header followed by the sorted hash values as
+    little-endian unsigned integers, so loading is a constant-time memory map
+    regardless of the number of keys.
+    """
+    _MAGIC = b'CSKEYIDX'
+    _HEADER = struct.Struct('<8sBBIQ')
+
+    def __init__(self, hashes, funcname, seed, buffer=None):
+        # `seed` is the derived integer seed passed to hash factories
+        self._hashes = hashes
+        self._funcname = funcname
+        self._seed = seed
+        self._buffer = buffer
+        self._func = _backend(funcname).factory(seed)
+        self._max_hash = _max_hash(funcname)
+
+    @classmethod
+    def build(cls, keys, funcname='xxhash32', seed='DEFAULT_SEED', rate=None):
+        """
+        Builds an index of `keys`, or only of those `sample_line()` would
+        select at `rate` if given.
+
+        :param keys: iterable of keys
+        :param funcname: name of hash function
+        :param seed: seed for hash function
+        :param rate: optional sampling rate from 0.0 to 1.0
+        :return: a :class:`KeyIndex`
+        """
+        func = _hash_with_seed(funcname, seed)
+        hashes = set(map(func, keys))
+        if rate is not None:
+            int_rate = _rate2int(rate, funcname)
+            hashes = [hashval for hashval in hashes if hashval < int_rate]
+        return cls(sorted(hashes), funcname, _derive_seed(seed))
+
+    def save(self, path):
+        """
+        Writes the index to file `path`.
+
+        :param path: path of index file
+        """
+        typecode = self._typecode(self._funcname)
+        values = array(typecode, self._hashes)
+        if sys.byteorder != 'little':
+            values.byteswap()
+        name = self._funcname.encode('utf-8')
+        with open(path, 'wb') as f:
+            f.write(self._HEADER.pack(self._MAGIC, 1, len(name), self._seed, len(values)))
+            f.write(name)
+            f.write(_array_tobytes(values))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Memory-maps an index file written by :meth:`save`.
+
+        :param path: path of index file
+        :return: a :class:`KeyIndex`
+        """
+        import mmap
+
+        with open(path, 'rb') as f:
+            header = f.read(cls._HEADER.size)
+            if len(header) != cls._HEADER.size:
+                raise ValueError('Not a key index: %s' % path)
+            magic, version, name_size, seed, count = cls._HEADER.unpack(header)
+            if magic != cls._MAGIC:
+                raise ValueError('Not a key index: %s' % path)
+            if version != 1:
+                raise ValueError('Unsupported key index version: %d' % version)
+            funcname = f.read(name_size).decode('utf-8')
+            offset = cls._HEADER.size + name_size
+            typecode = cls._typecode(funcname)
+
+            size = count * array(typecode).itemsize
+
+            if sys.byteorder != 'little' or count == 0 or not hasattr(memoryview, 'cast'):
+                # Empty files cannot be mapped, big-endian hosts need a
+                # converted copy and Python 2 can't cast memory views
+                data = f.read()
+                if len(data) != size:
+                    raise ValueError('Truncated key index: %s' % path)
+                values = array(typecode)
+                _array_frombytes(values, data)
+                if sys.byteorder != 'little':
+                    values.byteswap()
+                return cls(values, funcname, seed)
+
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(buf) - offset != size:
+            buf.close()
+            raise ValueError('Truncated key index: %s' % path)
+        return cls(memoryview(buf)[offset:].cast(typecode), funcname, seed, buf)
+
+    @staticmethod
+    def _typecode(funcname):
+        typecode = _hash_typecode(_backend(funcname).bits)
+        if typecode is None:
+            raise ValueError('Key index supports hashes up to 64 bits: %s' % funcname)
+        return typecode
+
+    def close(self):
+        """
+        Unmaps the index file, if any.
+        """
+        if self._buffer is not None:
+            self._hashes.release()
+            self._buffer.close()
+            self._buffer = None
+            self._hashes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def __contains__(self, data):
+        return self.contains_hash(self._func(data))
+
+    def contains_hash(self, hashval):
+        """
+        Checks whether a key with hash value `hashval` is in the index.
+
+        :param hashval: hash value computed with the index's hash function
+        """
+        hashes = self._hashes
+        i = bisect.bisect_left(hashes, hashval)
+        return i < len(hashes) and hashes[i] == hashval
+
+    def contains_many(self, keys, offsets=None):
+        """
+        Checks a whole batch of keys at once.
+
+        :param keys: sequence of keys or a bytes-like buffer (see `offsets`)
+        :param offsets: optional list of n + 1 offsets into buffer `keys`
+        :return: list of booleans
+        """
+        return list(map(self.contains_hash, _hash_many(self._func, keys, offsets)))
+
+    def should_sample(self, data, rate=None):
+        """
+        Same as :meth:`HashSampler.should_sample` for keys in the index, and
+        always False for other keys. Without `rate` every indexed key is
+        sampled.
+
+        :param data: any str to be hashed
+        :param rate: optional sampling rate from 0.0 to 1.0
+        """
+        hashval = self._func(data)
+        if rate is not None and hashval >= int(rate * self._max_hash):
+            return False
+        return self.contains_hash(hashval)
+
+
+class ReservoirSampler(object):
+    """Reservoir which is filled incrementally and can be merged with
+    reservoirs built over other parts of the data.
+
+    Elements can be added at any time and :meth:`snapshot` returns the
+    current sample without interrupting ingestion, which suits long running
+    processes such as log tailers.
+
+    Build one reservoir per shard, ship them to a coordinator with
+    :meth:`to_bytes` and merge them there. The result is a uniform sample of
+    the union of all shards:
+
+    >>> left = ReservoirSampler(2)
+    >>> left.extend(['alan', 'brad', 'cate'])
+    >>> right = ReservoirSampler(2)
+    >>> right.extend(['daan', 'emma'])
+    >>> merged = ReservoirSampler.from_bytes(left.to_bytes()).merge(right)
+    >>> merged.count, len(merged.snapshot())
+    (5, 2)
+    """
+    _FORMAT_VERSION = 1
+
+    def __init__(self, size, seed=None, keep_order=False):
+        """
+        Create an empty reservoir
+
+        :param size: sample size
+        :param seed: optional seed (any hashable object)
+        :param keep_order: make snapshots respect input order
+        """
+        self.size = size
+        self.count = 0
+        self.keep_order = keep_order
+        self._random = _private_random(seed)
+        # Slot i holds _values[i], which was the _indices[i]-th element seen
+        self._values = []
+        self._indices = array(_hash_typecode(64))
+        # Slots in input order, sorted by snapshot() when None
+        self._order = []
+
+    def add(self, value):
+        """
+        Feeds a single element into the reservoir.
+
+        :param value: anything
+        """
+        k = self.count
+        if k < self.size:
+            self._fill(k, value)
+        else:
+            position = self._random.randint(0, k)
+            if position < self.size:
+                self._replace(position, k, value)
+        self.count = k + 1
+
+    def extend(self, s):
+        """
+        Feeds every element of stream `s` into the reservoir.
+
+        :param s: stream of anything
+        """
+        size = self.size
+        randint = self._random.randint
+        replace = self._replace
+        k = self.count
+        s = iter(s)
+        try:
+            while k < size:
+                self._fill(k, next(s))
+                k += 1
+        except StopIteration:
+            self.count = k
+            return
+
+        for l in s:
+            position = randint(0, k)
+            if position < size:
+                replace(position, k, l)
+            k += 1
+        self.count = k
+
+    def _fill(self, k, value):
+        self._values.append(value)
+        self._indices.append(k)
+        self._order = None
+
+    def _replace(self, position, k, value):
+        self._values[position] = value
+        self._indices[position] = k
+        self._order = None
+
+    def snapshot(self):
+        """
+        Returns the current sample. Cheap enough to be called at any time
+        while elements keep being added.
+
+        :return: sampled list
+        """
+        if self.keep_order:
+            if self._order is None:
+                indices = self._indices
+                self._order = sorted(range(len(indices)), key=indices.__getitem__)
+            values = self._values
+            return [values[i] for i in self._order]
+        return list(self._values)
+
+    def merge(self, other):
+        """
+        Merges `other` into this reservoir, which then holds a uniform sample
+        of both streams combined. With `keep_order`, elements of this
+        reservoir's stream are considered to precede the ones of `other`.
+
+        Elements are drawn one by one from either reservoir in proportion to
+        the number of stream elements each of them has not yet accounted for.
+
+        :param other: a :class:`ReservoirSampler` of the same size
+        :return: this reservoir
+        """
+        if other.size != self.size:
+            raise ValueError('Cannot merge reservoirs of different sizes: %d, %d' % (self.size, other.size))
+
+        rand = self._random
+        taken = [0, 0]
+        remaining = [self.count, other.count]
+        for _ in range(min(self.size, self.count + other.count)):
+            index = 0 if rand.randrange(remaining[0] + remaining[1]) < remaining[0] else 1
+            taken[index] += 1
+            remaining[index] -= 1
+
+        mine = rand.sample(range(len(self._values)), taken[0])
+        theirs = rand.sample(range(len(other._values)), taken[1])
+        self._values = [self._values[i] for i in mine] + [other._values[i] for i in theirs]
+        self._indices = array(
+            _hash_typecode(64),
+            [self._indices[i] for i in mine] + [other._indices[i] + self.count for i in theirs]
+        )
+        self.count += other.count
+        self._order = None
+        return self
+
+    def to_bytes(self):
+        """
+        Serializes the reservoir (without its random state) so that it can be
+        sent to another process. Sampled values must be picklable.
+
+        :return: bytes
+        """
+        import pickle
+
+        state = (
+            self._FORMAT_VERSION, self.size, self.count, self.keep_order,
+            self._values, self._indices.tolist()
+        )
+        return pickle.dumps(state, pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def from_bytes(cls, data, seed=None):
+        """
+        Restores a reservoir serialized by :meth:`to_bytes`. The data is
+        unpickled, so only load it from trusted sources.
+
+        :param data: bytes returned by :meth:`to_bytes`
+        :param seed: optional seed for elements added from now on
+        :return: a :class:`ReservoirSampler`
+        """
+        import pickle
+
+        try:
+            state = pickle.loads(data)
+            version = state[0]
+        except Exception:
+            raise ValueError('Not a serialized reservoir')
+        if version != cls._FORMAT_VERSION:
+            raise ValueError('Unsupported reservoir format version: %r' % (version,))
+
+        _, size, count, keep_order, values, indices = state
+        self = cls(size, seed, keep_order)
+        self.count = count
+        self._values = values
+        self._indices = array(_hash_typecode(64), indices)
+        return self
+
+
+class WindowSampler(object):
+    """Uniform sample of the elements seen during the last `window` time
+    units, for long running processes which serve fresh samples of a live
+    stream.
+
+    Every element draws a random priority and the sample holds the `size`
+    elements of highest priority among those not yet expired (priority
+    sampling, Babcock, Datar and Motwani, 2002). An element is only kept
+    while fewer than `size` newer elements have a higher priority, since it
+    can't make it into any later sample otherwise. That leaves about
+    `size` * ln(n / `size`) elements for n elements per window, and the rest
+    is dropped by a periodic pass whose cost amortizes to O(log `size`) per
+    element.
+
+    Timestamps are taken from column `col` of tuples, passed to :meth:`add`,
+    or default to the current time, and are expected not to decrease:
+
+    >>> sampler = WindowSampler(2, window=40, col=0, seed=1)
+    >>> sampler.extend([(0, 'alan'), (30, 'brad'), (70, 'cate'), (80, 'daan')])
+    >>> sorted(name for _, name in sampler.snapshot())
+    ['cate', 'daan']
+    """
+    def __init__(self, size, window, col=None, seed=None):
+        """
+        Create an empty sampler
+
+        :param size: sample size
+        :param window: length of the window in the unit of the timestamps
+        :param col: index of column holding timestamps, or None
+        :param seed: optional seed (any hashable object)
+        """
+        if size <= 0:
+            raise ValueError('Sample size must be positive: %r' % (size,))
+        self.size = size
+        self.window = window
+        self.col = col
+        self.count = 0
+        self.latest = None
+        self._random = _private_random(seed)
+        # (timestamp, priority, value) of elements which may still be
+        # sampled, in input order
+        self._entries = collections.deque()
+        self._compact_at = 4 * size
+
+    def add(self, value, timestamp=None):
+        """
+        Feeds a single element into the sampler and expires old ones.
+
+        :param value: anything, or a tuple if `col` is set
+        :param timestamp: time of the element if `col` is None (defaults to
+            the current time)
+        """
+        if timestamp is None:
+            if self.col is None:
+                import time
+
+                timestamp = time.time()
+            else:
+                timestamp = float(value[self.col])
+        self._entries.append((timestamp, self._random.random(), value))
+        self.count += 1
+        if self.latest is None or timestamp > self.latest:
+            self.latest = timestamp
+            self._expire(timestamp)
+        if len(self._entries) >= self._compact_at:
+            self._compact()
+
+    def extend(self, s):
+        """
+        Feeds every element of stream `s` into the sampler.
+
+        :param s: stream of anything, or of tuples if `col` is set
+        """
+        add = self.add
+        for l in s:
+            add(l)
+
+    def snapshot(self, now=None):
+        """
+        Returns a uniform sample of the elements of the window ending at
+        `now`, in input order.
+
+        :param now: end of the window (defaults to the latest timestamp)
+        :return: sampled list
+        """
+        if now is None:
+            now = self.latest
+        if now is None:
+            return []
+        self._expire(now)
+
+        entries = self._entries
+        if len(entries) <= self.size:
+            return [value for _, _, value in entries]
+        threshold = heapq.nlargest(self.size, (priority for _, priority, _ in entries))[-1]
+        return [value for _, priority, value in entries if priority >= threshold]
+
+    def _expire(self, now):
+        entries = self._entries
+        oldest = now - self.window
+        while entries and entries[0][0] <= oldest:
+            entries.popleft()
+
+    def _compact(self):
+        # Walk from the newest element back, keeping those among the top
+        # `size` priorities of themselves and every newer element
+        size = self.size
+        heap = []
+        kept = []
+        for entry in reversed(self._entries):
+            priority = entry[1]
+            if len(heap) < size:
+                heapq.heappush(heap, priority)
+            elif priority > heap[0]:
+                heapq.heapreplace(heap, priority)
+            else:
+                continue
+            kept.append(entry)
+        kept.reverse()
+        self._entries = collections.deque(kept)
+        self._compact_at = max(2 * len(kept), 4 * size)
+
+
+def bottom_k(s, size, col=None, funcname='xxhash32', seed='DEFAULT_SEED'):
+    """Sample every element of the `size` distinct keys with the smallest
+    hash values, in one pass. See :class:`BottomKSampler`.
+
+    >>> logs = [('alan', 1), ('brad', 2), ('cate', 3), ('alan', 4), ('daan', 5)]
+    >>> bottom_k(logs, 2, 0)
+    [('cate', 3), ('daan', 5)]
+
+    :param s: stream of tuples, or of str (or bytes) keys if `col` is None
+    :param size: number of distinct keys to sample
+    :param col: index of column to be hashed, or None to hash whole elements
+    :param funcname: name of hash function: xxhash32 (default), spooky
+    :param seed: seed for hash function
+    :return: sampled list in input order
+    """
+    sampler = BottomKSampler(size, col, funcname, seed)
+    sampler.extend(s)
+    return sampler.snapshot()
+
+
+class BottomKSampler(object):
+    """Consistent sample of a fixed number of distinct keys: every row of the
+    `size` keys with the smallest hash values (bottom-k sampling).
+
+    Hash sampling fixes the rate and reservoir sampling fixes the size; a
+    bottom-k sample fixes the number of keys and, like hash sampling, picks
+    the same keys from any dataset containing them. Only rows of the current
+    `size` keys are held, in a heap bounded by `size`.
+
+    The largest kept hash also estimates the number of distinct keys seen
+    (the KMV estimator), and samplers built over different shards with the
+    same parameters merge into the sample of all shards combined:
+
+    >>> left = BottomKSampler(2, 0)
+    >>> left.extend([('alan', 1), ('brad', 2), ('alan', 3)])
+    >>> right = BottomKSampler(2, 0)
+    >>> right.extend([('cate', 4), ('daan', 5)])
+    >>> left.merge(right).snapshot()
+    [('cate', 4), ('daan', 5)]
+    """
+    _FORMAT_VERSION = 1
+
+    def __init__(self, size, col=None, funcname='xxhash32', seed='DEFAULT_SEED'):
+        """
+        Create an empty sampler
+
+        :param size: number of distinct keys to sample
+        :param col: index of column to be hashed, or None to hash whole rows
+        :param funcname: name of hash function: xxhash32 (default), spooky
+        :param seed: seed for hash function
+        """
+        if size <= 0:
+            raise ValueError('Sample size must be positive: %r' % (size,))
+        self.size = size
+        self.col = col
+        self.count = 0
+        self._funcname = funcname
+        self._seed = seed
+        self._func = _hash_with_seed(funcname, seed)
+        self._max_hash = _max_hash(funcname)
+        # Negated hashes of sampled keys, so that the largest is at the top
+        self._heap = []
+        # Hash of every sampled key -> list of (index, row) of its rows
+        self._rows = {}
+
+    def add(self, row):
+        """
+        Feeds a single row into the sampler.
+
+        :param row: tuple, or a str (or bytes) key if `col` is None
+        """
+        self.extend((row,))
+
+    def extend(self, s):
+        """
+        Feeds every row of stream `s` into the sampler.
+
+        :param s: stream of tuples, or of str (or bytes) keys if `col` is None
+        """
         func = self._func
+        col = self.col
+        size = self.size
+        heap = self._heap
+        rows = self._rows
+        k = self.count
+        # Rows hashing above the threshold can't get in, which is most of them
+        # once the sample is full
+        threshold = -heap[0] if len(heap) >= size else self._max_hash
+
+        for l in s:
+            hashval = func(l if col is None else l[col])
+            if hashval <= threshold:
+                key_rows = rows.get(hashval)
+                if key_rows is not None:
+                    key_rows.append((k, l))
+                else:
+                    rows[hashval] = [(k, l)]
+                    if len(heap) < size:
+                        heapq.heappush(heap, -hashval)
+                    else:
+                        del rows[-heapq.heapreplace(heap, -hashval)]
+                    if len(heap) >= size:
+                        threshold = -heap[0]
+            k += 1
+        self.count = k
+
+    def snapshot(self):
+        """
+        Returns every row of the sampled keys in input order.
+
+        :return: sampled list
+        """
+        rows = [r for key_rows in self._rows.values() for r in key_rows]
+        rows.sort(key=operator.itemgetter(0))
+        return [l for _, l in rows]
+
+    def hashes(self):
+        """
+        Returns the hash values of the sampled keys in ascending order.
+
+        :return: list of integers
+        """
+        return sorted(self._rows)
+
+    def estimate_distinct(self):
+        """
+        Estimates the number of distinct keys seen. The estimate is exact
+        while fewer than `size` keys were seen, and its relative standard
+        error is about 1/sqrt(`size`) otherwise.
+
+        :return: estimated number of distinct keys
+        """
+        if len(self._heap) < self.size:
+            return float(len(self._heap))
+        # The k-th smallest of n uniform values is about k / n
+        largest = (-self._heap[0] + 1) / (self._max_hash + 1)
+        return (self.size - 1) / largest
+
+    def to_key_index(self):
+        """
+        Returns a :class:`KeyIndex` of the sampled keys, e.g. to select the
+        same keys from other datasets.
+
+        :return: a :class:`KeyIndex`
+        """
+        return KeyIndex(self.hashes(), self._funcname, _derive_seed(self._seed))
+
+    def merge(self, other):
+        """
+        Merges `other` into this sampler, which then holds the sample of both
+        streams combined. Rows of `other` are considered to follow the rows
+        of this sampler's stream.
+
+        :param other: a :class:`BottomKSampler` with the same size, hash
+            function and seed
+        :return: this sampler
+        """
+        mine = (self.size, self._funcname, self._seed)
+        theirs = (other.size, other._funcname, other._seed)
+        if mine != theirs:
+            raise ValueError('Cannot merge samplers of different parameters: %r, %r' % (mine, theirs))
+
+        rows = self._rows
+        for hashval, key_rows in other._rows.items():
+            shifted = [(k + self.count, l) for k, l in key_rows]
+            if hashval in rows:
+                rows[hashval] = rows[hashval] + shifted
+            else:
+                rows[hashval] = shifted
+
+        kept = heapq.nsmallest(self.size, rows)
+        self._rows = dict((hashval, rows[hashval]) for hashval in kept)
+        self._heap = [-hashval for hashval in kept]
+        heapq.heapify(self._heap)
+        self.count += other.count
+        return self
+
+    def to_bytes(self):
+        """
+        Serializes the sampler so that it can be sent to another process.
+        Rows and the seed must be picklable.
+
+        :return: bytes
+        """
+        import pickle
+
+        state = (
+            self._FORMAT_VERSION, self.size, self.col, self._funcname, self._seed,
+            self.count, self._rows
+        )
+        return pickle.dumps(state, pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Restores a sampler serialized by :meth:`to_bytes`. The data is
+        unpickled, so only load it from trusted sources.
+
+        :param data: bytes returned by :meth:`to_bytes`
+        :return: a :class:`BottomKSampler`
+        """
+        import pickle
 
-        def assign_func(data):
-            hashval = func(data)
-            for index, low, high in ranges:
-                if low <= hashval < high:
-                    return index
+        try:
+            state = pickle.loads(data)
+            version = state[0]
+        except Exception:
+            raise ValueError('Not a serialized bottom-k sampler')
+        if version != cls._FORMAT_VERSION:
+            raise ValueError('Unsupported bottom-k sampler format version: %r' % (version,))
 
-        return assign_func
+        _, size, col, funcname, seed, count, rows = state
+        self = cls(size, col, funcname, seed)
+        self.count = count
+        self._rows = rows
+        self._heap = [-hashval for hashval in rows]
+        heapq.heapify(self._heap)
+        return self
 
 
 if __name__ == '__main__':
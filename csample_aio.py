@@ -0,0 +1,141 @@
+"""
+csample_aio: asyncio adapters for csample
+
+The functions accept both async iterables and plain iterables and make
+exactly the same decisions as their synchronous counterparts in
+:mod:`csample`. Plain iterables are hashed in micro-batches, handing control
+back to the event loop between batches; rows of async iterables are hashed
+as soon as they arrive.
+"""
+import asyncio
+import itertools
+
+import csample
+
+
+async def sample_tuple_async(s, rate, col, funcname='xxhash32', seed='DEFAULT_SEED', batch_size=1024):
+    """Asynchronous version of :func:`csample.sample_tuple`.
+
+    :param s: async iterable or iterable of tuples
+    :param rate: sampling rate from 0.0 to 1.0
+    :param col: index of column to be hashed
+    :param funcname: name of hash function: xxhash32 (default), spooky
+    :param seed: seed for hash function
+    :param batch_size: number of tuples hashed between yields to the loop
+    :return: async generator of sampled tuples
+    """
+    func = csample._hash_with_seed(funcname, seed)
+    int_rate = csample._rate2int(rate, funcname)
+
+    if hasattr(s, '__aiter__'):
+        async for l in s:
+            if func(l[col]) < int_rate:
+                yield l
+        return
+
+    async for batch in _batches(s, batch_size):
+        hashes = list(map(func, [l[col] for l in batch]))
+        for l, hashval in zip(batch, hashes):
+            if hashval < int_rate:
+                yield l
+
+
+async def sample_line_async(s, rate, funcname='xxhash32', seed='DEFAULT_SEED', batch_size=1024):
+    """Asynchronous version of :func:`csample.sample_line`.
+
+    :param s: async iterable or iterable of strings
+    :param rate: sampling rate from 0.0 to 1.0
+    :param funcname: name of hash function: xxhash32 (default), spooky
+    :param seed: seed for hash function
+    :param batch_size: number of strings hashed between yields to the loop
+    :return: async generator of sampled strings
+    """
+    async for l in sample_tuple_async(_wrap(s), rate, 0, funcname, seed, batch_size):
+        yield l[0]
+
+
+async def partition_tuple_async(s, ratios, col, queues, funcname='xxhash32', seed='DEFAULT_SEED',
+                                batch_size=1024, close=True):
+    """Asynchronous version of :func:`csample.partition_tuple_into` which
+    feeds one :class:`asyncio.Queue` per ratio.
+
+    Every tuple is hashed once and put into its queue. Bounded queues apply
+    backpressure: the coroutine waits while the queue of the next tuple is
+    full.
+
+    :param s: async iterable or iterable of tuples
+    :param ratios: list of ratios whose sum is equal to 1.0
+    :param col: index of column to be hashed
+    :param queues: one queue per ratio
+    :param funcname: name of hash function: xxhash32 (default), spooky
+    :param seed: seed for hash function
+    :param batch_size: number of tuples hashed between yields to the loop
+    :param close: put None into every queue once `s` is exhausted
+    :return: number of tuples put into each queue
+    """
+    assign = csample.Assigner(csample._hash_with_seed(funcname, seed), ratios, csample._max_hash(funcname))
+    counts = [0] * len(queues)
+
+    if hasattr(s, '__aiter__'):
+        async for l in s:
+            index = assign(l[col])
+            await queues[index].put(l)
+            counts[index] += 1
+    else:
+        async for batch in _batches(s, batch_size):
+            indices = assign.assign_many([l[col] for l in batch])
+            for l, index in zip(batch, indices):
+                await queues[index].put(l)
+                counts[index] += 1
+
+    if close:
+        for queue in queues:
+            await queue.put(None)
+    return counts
+
+
+async def partition_line_async(s, ratios, queues, funcname='xxhash32', seed='DEFAULT_SEED',
+                               batch_size=1024, close=True):
+    """Asynchronous version of :func:`csample.partition_line_into`, see
+    :func:`partition_tuple_async`.
+
+    :param s: async iterable or iterable of strings
+    :param ratios: list of ratios whose sum is equal to 1.0
+    :param queues: one queue per ratio
+    :param funcname: name of hash function: xxhash32 (default), spooky
+    :param seed: seed for hash function
+    :param batch_size: number of strings hashed between yields to the loop
+    :param close: put None into every queue once `s` is exhausted
+    :return: number of strings put into each queue
+    """
+    sinks = [_Unwrap(queue) for queue in queues]
+    return await partition_tuple_async(_wrap(s), ratios, 0, sinks, funcname, seed, batch_size, close)
+
+
+async def _batches(s, batch_size):
+    s = iter(s)
+    while True:
+        batch = list(itertools.islice(s, batch_size))
+        if not batch:
+            return
+        yield batch
+        await asyncio.sleep(0)
+
+
+def _wrap(s):
+    if hasattr(s, '__aiter__'):
+        return _awrap(s)
+    return ((l,) for l in s)
+
+
+async def _awrap(s):
+    async for l in s:
+        yield (l,)
+
+
+class _Unwrap(object):
+    def __init__(self, queue):
+        self._queue = queue
+
+    def put(self, l):
+        return self._queue.put(None if l is None else l[0])
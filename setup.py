@@ -25,6 +25,10 @@ if sys.version_info < (2, 7):
 
 test_requires = ['coverage', 'mock', 'nose']
 
+py_modules = ['csample']
+if sys.version_info >= (3, 6):
+    py_modules.append('csample_aio')
+
 setup(
     name='csample',
     version=get_version('csample.py'),
@@ -33,7 +37,7 @@ setup(
     author='Alan Kang',
     author_email='alankang@boxnwhis.kr',
     url='https://github.com/box-and-whisker/csample',
-    py_modules=['csample'],
+    py_modules=py_modules,
     package_data={'': ['README.rst']},
     include_package_data=True,
     install_requires=install_requires,
@@ -1,11 +1,43 @@
 from __future__ import division
 
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
 import unittest
 
 from six import StringIO
 
 import csample
 
+if sys.version_info >= (3, 6):
+    import asyncio
+    import csample_aio
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+try:
+    import pandas
+except ImportError:
+    pandas = None
+
+try:
+    import polars
+except ImportError:
+    polars = None
+
 
 HASHES = [
     'xxhash32',
@@ -29,12 +61,237 @@ class CLITest(unittest.TestCase):
         csample.main(['-r 1.0', '-c 1'], sin, sout)
         self.assertEqual(self.data, sout.getvalue())
 
+    def test_stratified_hash_sampling(self):
+        fd, path = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as f:
+            f.write('# stratum rate\nuser1 1.0\nuser2 0.0\n')
+        try:
+            sout = StringIO()
+            csample.main(['-r 0.5', '-c 0', '--strata-col=1', '--strata-file=%s' % path], StringIO(self.data), sout)
+        finally:
+            os.remove(path)
+
+        sampler = csample.HashSampler()
+        expected = ''.join(
+            l for l in self.data.splitlines(True)
+            if l.strip().endswith('user1') or
+            (not l.strip().endswith('user2') and sampler.should_sample(l.split(',')[0], 0.5))
+        )
+        self.assertEqual(expected, sout.getvalue())
+
+    def test_composite_key_hash_sampling(self):
+        lines = ['%d,x,user%d,end\n' % (i, i % 10) for i in range(0, 100)]
+        sampler = csample.HashSampler()
+        expected = ''.join(l for i, l in enumerate(lines) if sampler.should_sample('user%d,%d' % (i % 10, i), 0.5))
+        sout = StringIO()
+        csample.main(['-r 0.5', '-c 2,0'], StringIO(''.join(lines)), sout)
+        self.assertEqual(expected, sout.getvalue())
+
+    def test_csv_hash_sampling(self):
+        records = ['%d,"user, %d","multi\nline"\n' % (i, i % 10) for i in range(0, 100)]
+        sampler = csample.HashSampler()
+        expected = ''.join(r for i, r in enumerate(records) if sampler.should_sample('user, %d' % (i % 10), 0.5))
+        sout = StringIO()
+        csample.main(['-r 0.5', '-c 1', '--format=csv'], StringIO(''.join(records)), sout)
+        self.assertEqual(expected, sout.getvalue())
+
+        records = [r.replace(',"', '\t"') for r in records]
+        expected = ''.join(r for i, r in enumerate(records) if sampler.should_sample('user, %d' % (i % 10), 0.5))
+        sout = StringIO()
+        csample.main(['-r 0.5', '-c 1', '--format=tsv', '--line-buffered'], StringIO(''.join(records)), sout)
+        self.assertEqual(expected, sout.getvalue())
+
+    def test_jsonl_hash_sampling(self):
+        lines = ['{"user": {"id": "user%d"}, "tenant": %d}\n' % (i % 10, i % 3) for i in range(0, 100)]
+        sampler = csample.HashSampler()
+        expected = ''.join(
+            l for i, l in enumerate(lines) if sampler.should_sample('user%d,%d' % (i % 10, i % 3), 0.5)
+        )
+        sout = StringIO()
+        csample.main(['-r 0.5', '--format=jsonl', '--key=user.id,tenant'], StringIO(''.join(lines)), sout)
+        self.assertEqual(expected, sout.getvalue())
+
+    def test_tiered_hash_sampling(self):
+        directory = tempfile.mkdtemp()
+        try:
+            template = os.path.join(directory, 'tier_{rate}.log')
+            csample.main(['-r 0.5,0.1,1.0', '-c 1', '-o', template], StringIO(self.data), StringIO())
+            for rate in ('0.5', '0.1', '1.0'):
+                sout = StringIO()
+                csample.main(['-r', rate, '-c 1'], StringIO(self.data), sout)
+                with open(template.format(rate=rate)) as f:
+                    self.assertEqual(sout.getvalue(), f.read())
+
+            path = os.path.join(directory, 'single.log')
+            csample.main(['-r 0.5', '-c 1', '-o', path], StringIO(self.data), StringIO())
+            sout = StringIO()
+            csample.main(['-r 0.5', '-c 1'], StringIO(self.data), sout)
+            with open(path) as f:
+                self.assertEqual(sout.getvalue(), f.read())
+
+            csample.main(['-r 0.5', '-c 1', '-o', template], StringIO(self.data), StringIO())
+            with open(template.format(rate=0.5)) as f:
+                self.assertEqual(sout.getvalue(), f.read())
+        finally:
+            shutil.rmtree(directory)
+
+    def test_output_buffering(self):
+        sout = StringIO()
+        csample.main(['-r 0.5'], StringIO(self.data), sout)
+        expected = sout.getvalue()
+
+        for args in (['--line-buffered'], ['--flush-lines=3'], ['--buffer-size=10', '--chunk-size=3']):
+            sout = StringIO()
+            csample.main(['-r 0.5'] + args, StringIO(self.data), sout)
+            self.assertEqual(expected, sout.getvalue(), args)
+
+    def test_line_count_flushing(self):
+        flushed = []
+
+        class Stream(StringIO):
+            def flush(self):
+                flushed.append(self.getvalue())
+
+        sout = Stream()
+        writer = csample._ChunkedWriter(sout, flush_lines=2)
+        for piece in ('a\n', 'b\nc\n', 'd\n', 'e\n'):
+            writer.write(piece)
+        self.assertEqual(['a\nb\nc\n', 'a\nb\nc\nd\ne\n'], flushed)
+        writer.close()
+
+    def test_timed_output_flushing(self):
+        sout = StringIO()
+        writer = csample._ChunkedWriter(sout, flush_interval=0.01)
+        try:
+            writer.write('a\n')
+            for _ in range(100):
+                if sout.getvalue():
+                    break
+                time.sleep(0.01)
+            self.assertEqual('a\n', sout.getvalue())
+        finally:
+            writer.close()
+
+    def test_parallel_hash_sampling(self):
+        data = ''.join('%d, user%d\n' % (i, i % 37) for i in range(0, 1000))
+        sout = StringIO()
+        csample.main(['-r 0.5', '-c 1'], StringIO(data), sout)
+        expected = sout.getvalue()
+
+        sout = StringIO()
+        csample.main(['-r 0.5', '-c 1', '-j 2', '--chunk-size=7'], StringIO(data), sout)
+        self.assertEqual(expected, sout.getvalue())
+
+        sout = StringIO()
+        csample.main(['-r 0.5', '-c 1', '-j 2', '--chunk-size=7', '--unordered'], StringIO(data), sout)
+        self.assertEqual(sorted(expected.splitlines()), sorted(sout.getvalue().splitlines()))
+
+    def test_file_input(self):
+        # Carriage returns are kept and only '\n' ends a line, as on standard
+        # input; the last line has no line end
+        data = ''.join(
+            '%d,user%d%s' % (i, i % 10, '\r\n' if i % 3 else '\r' if i % 7 else '\n') for i in range(0, 100)
+        ).rstrip('\n').encode('ascii')
+        fd, path = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        command = [sys.executable, '-c', 'import csample; csample.main()']
+        cwd = os.path.dirname(os.path.abspath(__file__))
+        try:
+            for args in (['-r 0.5'], ['-r 0.5', '-c 1'], ['-r 0.5', '-c 0'], ['-r 0.5', '-c 1,0']):
+                with open(path, 'rb') as sin:
+                    expected = subprocess.check_output(command + args, stdin=sin, cwd=cwd)
+                self.assertTrue(0 < len(expected) < len(data))
+                # Memory-mapped raw bytes
+                sout = subprocess.check_output(command + args + ['--input=%s' % path], cwd=cwd)
+                self.assertEqual(expected, sout, args)
+                # Text streams without a binary buffer
+                text = expected if str is bytes else expected.decode('utf-8')
+                for extra in ([], ['-j 2'], ['--line-buffered']):
+                    sout = StringIO()
+                    csample.main(args + extra + ['--input=%s' % path], StringIO(), sout)
+                    self.assertEqual(text, sout.getvalue(), args + extra)
+        finally:
+            os.remove(path)
+
+    def test_compressed_files(self):
+        sout = StringIO()
+        csample.main(['-r 0.5', '-c 1'], StringIO(self.data), sout)
+        directory = tempfile.mkdtemp()
+        try:
+            # lzma needs Python 3.3+
+            for ext in ('.gz', '.bz2', '.xz') if sys.version_info >= (3, 3) else ('.gz', '.bz2'):
+                path = os.path.join(directory, 'input' + ext)
+                with csample._open_output(path) as f:
+                    f.write(self.data)
+                output = os.path.join(directory, 'output' + ext)
+                csample.main(['-r 0.5', '-c 1', '-i', path, '-o', output, '--compress-level=1'])
+                with csample._open_input(output) as f:
+                    self.assertEqual(sout.getvalue(), f.read(), ext)
+        finally:
+            shutil.rmtree(directory)
+
+    @unittest.skipIf(not hasattr(signal, 'SIGUSR1'), 'SIGUSR1 is not available')
+    def test_stats(self):
+        def lines():
+            for i, l in enumerate(StringIO(self.data)):
+                if i == 50:
+                    os.kill(os.getpid(), signal.SIGUSR1)
+                yield l
+
+        stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            sout = StringIO()
+            csample.main(['-r 0.5', '--stats', '--line-buffered'], lines(), sout)
+            reports = [json.loads(l) for l in sys.stderr.getvalue().splitlines()]
+        finally:
+            sys.stderr = stderr
+
+        self.assertEqual(2, len(reports))
+        self.assertTrue(0 < reports[0]['rows_in'] < 100)
+        self.assertEqual(100, reports[1]['rows_in'])
+        self.assertEqual(len(sout.getvalue().splitlines()), reports[1]['rows_out'])
+        self.assertEqual(0.5, reports[1]['rate'])
+        self.assertEqual(signal.SIG_DFL, signal.getsignal(signal.SIGUSR1))
+
+    def test_stats_rows_out(self):
+        def report(args):
+            stderr = sys.stderr
+            sys.stderr = StringIO()
+            try:
+                csample.main(args + ['--stats'], StringIO(self.data), StringIO())
+                return json.loads(sys.stderr.getvalue())
+            finally:
+                sys.stderr = stderr
+
+        # The last line has no trailing newline
+        for args in (['-r 1.0'], ['-r 1.0', '--line-buffered'], ['-r 1.0', '-j 2'], ['-r 200', '--method=reservoir']):
+            stats = report(args)
+            self.assertEqual((100, 100, 1.0), (stats['rows_in'], stats['rows_out'], stats['keep_ratio']), args)
+
+        directory = tempfile.mkdtemp()
+        try:
+            template = os.path.join(directory, 'tier_{rate}.log')
+            stats = report(['-r 0.5,0.1', '-c 1', '-o', template])
+            with open(template.format(rate=0.5)) as f:
+                self.assertEqual(len(f.read().splitlines()), stats['rows_out'])
+            self.assertEqual(stats['rows_out'], max(stats['counts']))
+        finally:
+            shutil.rmtree(directory)
+
     def test_reservoir_sampling(self):
         sin = StringIO(self.data)
         sout = StringIO()
         csample.main(['-r 100', '--method=reservoir'], sin, sout)
         self.assertEqual(self.data, sout.getvalue())
 
+    def test_weighted_reservoir_sampling(self):
+        sin = StringIO(self.data)
+        sout = StringIO()
+        csample.main(['-r 100', '--method=weighted-reservoir', '--weight-col=0', '--order'], sin, sout)
+        self.assertEqual(self.data.split('\n')[1:], sout.getvalue().split('\n'))
+
     def test_argument_parsing(self):
         args = csample.parse_arguments(['-r0.5', '-c3', '-stest', '--hash=spooky32', '--sep=.', '--order'])
         self.assertEqual(0.5, args.rate)
@@ -45,6 +302,33 @@ class CLITest(unittest.TestCase):
         self.assertEqual('.', args.sep)
         self.assertEqual(True, args.order)
 
+        args = csample.parse_arguments(['-r0.5', '-c2,5'])
+        self.assertEqual([2, 5], args.col)
+
+        stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            self.assertRaises(SystemExit, csample.parse_arguments, ['-r10', '--method=weighted-reservoir'])
+            for args in (['-r0.1,0.2'], ['-r0.1,0.2', '-o', 'out.log'],
+                         ['-r10,20', '--method=reservoir', '-o', 'tier_{rate}.log'],
+                         ['-r0.1,0.2', '--strata-col=1', '-o', 'tier_{rate}.log']):
+                self.assertRaises(SystemExit, csample.parse_arguments, args)
+        finally:
+            sys.stderr = stderr
+
+
+class ImportTest(unittest.TestCase):
+    def test_lazy_imports(self):
+        # Keeps `csample` startup close to a bare interpreter; check the
+        # remaining cost with `make importtime`
+        code = (
+            'import sys, csample; '
+            'print(",".join(m for m in ("argparse", "six", "xxhash", "spooky", "pickle", "random") '
+            'if m in sys.modules))'
+        )
+        loaded = subprocess.check_output([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(b'', loaded.strip())
+
 
 class FunctionBasedAPITest(unittest.TestCase):
     def test_sample_line(self):
@@ -59,6 +343,54 @@ class FunctionBasedAPITest(unittest.TestCase):
         for k, v in outs:
             self.assertEqual(k, str(v))
 
+    def test_sample_batch(self):
+        ins = [str(i) for i in range(0, 1000)]
+        expected = list(csample.sample_line(ins, 0.5))
+        mask = csample.sample_batch(ins, 0.5)
+        self.assertEqual(expected, [i for i, m in zip(ins, mask) if m])
+        indices = csample.sample_batch(ins, 0.5, indices=True)
+        self.assertEqual(expected, [ins[i] for i in indices])
+
+    def test_sample_batch_with_offsets(self):
+        ins = [str(i) for i in range(0, 1000)]
+        data = ''.join(ins).encode('utf-8')
+        offsets = [0]
+        for i in ins:
+            offsets.append(offsets[-1] + len(i))
+        self.assertEqual(
+            csample.sample_batch(ins, 0.5),
+            csample.sample_batch(data, 0.5, offsets=offsets)
+        )
+
+    @unittest.skipIf(numpy is None, 'NumPy is not installed')
+    def test_sample_batch_vectorized(self):
+        # Every length around the 4 and 16 byte steps of XXH32, non-ASCII
+        # and NUL characters
+        ins = [(u'\xe9a\0b' * 20)[i % 7:i % 7 + n] for i, n in enumerate(range(0, 70))] * 3
+        data = u''.join(ins).encode('utf-8')
+        offsets = [0]
+        for i in ins:
+            offsets.append(offsets[-1] + len(i.encode('utf-8')))
+        expected = [i for i, l in enumerate(ins) if list(csample.sample_line([l], 0.5))]
+        self.assertEqual(expected, csample.sample_batch(ins, 0.5, indices=True))
+        self.assertEqual(expected, csample.sample_batch(data, 0.5, offsets=numpy.array(offsets), indices=True))
+        sliced = csample.sample_batch(data, 0.5, offsets=offsets[1:], indices=True)
+        self.assertEqual([i for i in expected if i > 0], [i + 1 for i in sliced])
+
+        assigner = csample.HashSampler().assign_for([0.2] * 5)
+        self.assertEqual([assigner(l) for l in ins], list(assigner.assign_many(ins)))
+
+    def test_sample_stratified(self):
+        ins = [(str(i), i % 3) for i in range(0, 1000)]
+        rates = {0: 1.0, 1: 0.2}
+        outs = list(csample.sample_stratified(ins, rates, 0, 1))
+        for stratum, rate in ((0, 1.0), (1, 0.2), (2, 0.0)):
+            expected = csample.sample_tuple([l for l in ins if l[1] == stratum], rate, 0)
+            self.assertEqual(list(expected), [l for l in outs if l[1] == stratum])
+
+        outs = list(csample.sample_stratified(ins, lambda stratum: rates.get(stratum, 0.5), 0, 1))
+        self.assertEqual(outs, list(csample.sample_stratified(ins, rates, 0, 1, default_rate=0.5)))
+
     def test_hash_functions(self):
         for funcname in HASHES:
             csample.sample_line(['a', 'b'], 0.5, funcname)
@@ -68,6 +400,119 @@ class FunctionBasedAPITest(unittest.TestCase):
             csample.sample_line, ['a', 'b'], 0.5, 'unknown_func'
         )
 
+    def test_wide_hash_functions(self):
+        ins = [str(i) for i in range(0, 30000)]
+        # blake2b needs Python 3.6+
+        for funcname in ('xxhash64', 'blake2b') if sys.version_info >= (3, 6) else ('xxhash64',):
+            outs = list(csample.sample_line(ins, 0.3, funcname))
+            self.assertAlmostEqual(0.3, len(outs) / len(ins), 2, funcname)
+            mask = csample.sample_batch(ins, 0.3, funcname)
+            self.assertEqual(outs, [i for i, m in zip(ins, mask) if m])
+
+    def test_register_hash(self):
+        calls = []
+
+        def batch_factory(seed):
+            def batch(keys, offsets=None):
+                calls.append(keys)
+                return [int(k) for k in keys]
+            return batch
+
+        csample.register_hash('identity8', lambda seed: int, 8, batch_factory)
+        try:
+            self.assertTrue('identity8' in csample.hash_functions())
+            ins = [str(i) for i in range(0, 256)]
+            self.assertEqual(ins[:127], list(csample.sample_line(ins, 0.5, 'identity8')))
+            self.assertEqual(list(range(127)), csample.sample_batch(ins, 0.5, 'identity8', indices=True))
+            self.assertEqual([ins], calls)
+        finally:
+            del csample._hash_backends['identity8']
+
+    def test_stats(self):
+        ins = ['user%d' % i for i in range(1000)]
+        stats = csample.Stats(profile_every=10)
+        outs = list(csample.sample_line(ins, 0.3, stats=stats))
+        self.assertEqual((1000, len(outs), 0.3), (stats.rows_in, stats.rows_out, stats.rate))
+        self.assertTrue(stats.seconds['hash'] > 0)
+
+        stats = csample.Stats()
+        counts = csample.partition_line_into(ins, [0.5, 0.3, 0.2], [[], [], []], stats=stats)
+        self.assertEqual(counts, stats.counts)
+        self.assertEqual(1000, stats.rows_in)
+
+        stats = csample.Stats()
+        assigner = csample.HashSampler().assign_for([0.5, 0.5], stats=stats)
+        indices = [assigner(k) for k in ins] + list(assigner.assign_many(ins))
+        self.assertEqual([indices.count(0), indices.count(1)], stats.counts)
+        self.assertEqual(2000, json.loads(stats.to_json())['rows_in'])
+
+    def _frames(self, keys):
+        frames = []
+        if pyarrow is not None:
+            table = pyarrow.table({'key': keys, 'value': list(range(len(keys)))})
+            half = len(keys) // 2
+            frames.append((table, lambda t: t.column('value').to_pylist()))
+            # Several chunks and sliced chunks
+            chunked = pyarrow.concat_tables([table.slice(0, half), table.slice(half)])
+            frames.append((chunked, lambda t: t.column('value').to_pylist()))
+        if pandas is not None:
+            frame = pandas.DataFrame({'key': keys, 'value': range(len(keys))})
+            frames.append((frame, lambda df: df['value'].tolist()))
+            frames.append((frame.astype({'key': object}), lambda df: df['value'].tolist()))
+        if polars is not None:
+            frame = polars.DataFrame({'key': keys, 'value': range(len(keys))})
+            frames.append((frame, lambda df: df['value'].to_list()))
+        return frames
+
+    @unittest.skipIf(pyarrow is None and pandas is None and polars is None, 'no data frame library')
+    def test_sample_frame(self):
+        keys = ['user%d' % (i % 100) for i in range(1000)]
+        rows = [(k, i) for i, k in enumerate(keys)]
+        expected = [i for _, i in csample.sample_tuple(rows, 0.3, 0)]
+        for frame, values in self._frames(keys):
+            self.assertEqual(expected, values(csample.sample_frame(frame, 0.3, 'key')), type(frame))
+
+    @unittest.skipIf(pyarrow is None and pandas is None and polars is None, 'no data frame library')
+    def test_partition_frame(self):
+        keys = ['user%d' % (i % 100) for i in range(1000)]
+        rows = [(k, i) for i, k in enumerate(keys)]
+        sinks = [[], [], []]
+        csample.partition_tuple_into(rows, [0.5, 0.3, 0.2], 0, sinks)
+        expected = [[i for _, i in sink] for sink in sinks]
+        for frame, values in self._frames(keys):
+            partitions = csample.partition_frame(frame, [0.5, 0.3, 0.2], 'key')
+            self.assertEqual(expected, [values(p) for p in partitions], type(frame))
+
+    @unittest.skipIf(pyarrow is None and pandas is None and polars is None, 'no data frame library')
+    def test_sample_frame_non_string_keys(self):
+        for keys in ([i % 100 for i in range(1000)], [float(i % 100) for i in range(1000)]):
+            rows = [(str(k), i) for i, k in enumerate(keys)]
+            expected = [i for _, i in csample.sample_tuple(rows, 0.3, 0)]
+            for frame, values in self._frames(keys):
+                self.assertEqual(expected, values(csample.sample_frame(frame, 0.3, 'key')), type(frame))
+
+
+    @unittest.skipIf(pyarrow is None and pandas is None and polars is None, 'no data frame library')
+    def test_frame_empty_selection(self):
+        keys = ['user%d' % i for i in range(10)]
+        rows = [(k, i) for i, k in enumerate(keys)]
+        sinks = [[], [], []]
+        csample.partition_tuple_into(rows, [0.98, 0.01, 0.01], 0, sinks)
+        expected = [[i for _, i in sink] for sink in sinks]
+        self.assertIn([], expected)
+        for frame, values in self._frames(keys):
+            self.assertEqual([], values(csample.sample_frame(frame, 0.0, 'key')), type(frame))
+            partitions = csample.partition_frame(frame, [0.98, 0.01, 0.01], 'key')
+            self.assertEqual(expected, [values(p) for p in partitions], type(frame))
+
+    @unittest.skipIf(pandas is None, 'pandas is not installed')
+    def test_sample_frame_int_column_name(self):
+        keys = ['user%d' % (i % 100) for i in range(1000)]
+        rows = [(k, i) for i, k in enumerate(keys)]
+        expected = [i for _, i in csample.sample_tuple(rows, 0.3, 0)]
+        frame = pandas.DataFrame({'value': range(len(keys)), 5: keys})
+        self.assertEqual(expected, csample.sample_frame(frame, 0.3, 5)['value'].tolist())
+        self.assertEqual(expected, csample.sample_frame(frame, 0.3, 1)['value'].tolist())
 
 class ClassBasedAPITest(unittest.TestCase):
     def setUp(self):
@@ -78,6 +523,11 @@ class ClassBasedAPITest(unittest.TestCase):
         outs = list(i for i in ins if self.sampler.should_sample(i, 0.5))
         self.assertTrue(set(outs).issubset(set(ins)))
 
+    def test_should_sample_many(self):
+        ins = [str(i) for i in range(0, 100)]
+        expected = [self.sampler.should_sample(i, 0.5) for i in ins]
+        self.assertEqual(expected, self.sampler.should_sample_many(ins, 0.5))
+
     def test_assign(self):
         n_sample = 10000
         ins = [str(i) for i in range(0, n_sample)]
@@ -92,6 +542,109 @@ class ClassBasedAPITest(unittest.TestCase):
         self.assertAlmostEqual(ratios[1], counts[1] / n_sample, 2)
         self.assertAlmostEqual(ratios[2], counts[2] / n_sample, 2)
 
+    def test_assign_many(self):
+        ins = [str(i) for i in range(0, 10000)]
+        ratios = [1 / 150] * 150
+        assigner = self.sampler.assign_for(ratios)
+        indices = assigner.assign_many(ins)
+        self.assertEqual([assigner(i) for i in ins], list(indices))
+        self.assertEqual([self.sampler.assign(i, ratios) for i in ins], list(indices))
+        self.assertEqual(set(range(150)), set(indices))
+
+    def test_cached_sampler(self):
+        sampler = csample.HashSampler(cache_size=10)
+        self.assertEqual(None, self.sampler.cache_info())
+
+        ins = [str(i % 15) for i in range(0, 300)]
+        expected = [self.sampler.should_sample(i, 0.5) for i in ins]
+        self.assertEqual(expected, [sampler.should_sample(i, 0.5) for i in ins])
+        self.assertEqual(expected, sampler.should_sample_many(ins, 0.5))
+
+        assigner = sampler.assign_for([0.2, 0.8])
+        self.assertEqual(
+            list(self.sampler.assign_for([0.2, 0.8]).assign_many(ins)),
+            [assigner(i) for i in ins]
+        )
+
+        info = sampler.cache_info()
+        self.assertEqual(10, info.maxsize)
+        self.assertEqual(10, info.currsize)
+        self.assertEqual(900, info.hits + info.misses)
+
+        hot = csample.HashSampler(cache_size=10)
+        for i in range(0, 100):
+            hot.should_sample('hot', 0.5)
+        self.assertEqual((99, 1), hot.cache_info()[:2])
+
+    def test_cached_sampler_threads(self):
+        import threading
+
+        sampler = csample.HashSampler(cache_size=50)
+        ins = ['k%d' % i for i in range(0, 400)]
+        expected = [self.sampler.should_sample(i, 0.5) for i in ins]
+        results = []
+        errors = []
+
+        def check():
+            try:
+                for _ in range(0, 50):
+                    results.append(expected == [sampler.should_sample(i, 0.5) for i in ins])
+            except Exception as e:
+                errors.append(e)
+
+        # Switching threads as often as possible makes races likely
+        interval = sys.getswitchinterval() if hasattr(sys, 'getswitchinterval') else None
+        if interval is not None:
+            sys.setswitchinterval(1e-6)
+        try:
+            threads = [threading.Thread(target=check) for _ in range(0, 8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            if interval is not None:
+                sys.setswitchinterval(interval)
+        self.assertEqual([], errors)
+        self.assertEqual([True] * 400, results)
+        info = sampler.cache_info()
+        self.assertEqual((50, 50, 8 * 50 * 400), (info.maxsize, info.currsize, info.hits + info.misses))
+
+    def test_key_index(self):
+        ins = [str(i) for i in range(0, 1000)]
+        sampled = set(csample.sample_line(ins, 0.3))
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            for funcname in ('xxhash32', 'xxhash64'):
+                csample.KeyIndex.build(ins, funcname, 'seed', rate=0.3).save(path)
+                sampler = csample.HashSampler(funcname, 'seed')
+                with csample.KeyIndex.load(path) as index:
+                    self.assertEqual(len(set(i for i in ins if sampler.should_sample(i, 0.3))), len(index))
+                    for i in ins:
+                        self.assertEqual(sampler.should_sample(i, 0.3), i in index)
+                        self.assertEqual(sampler.should_sample(i, 0.1), index.should_sample(i, 0.1))
+                    self.assertEqual([sampler.should_sample(i, 0.3) for i in ins], index.contains_many(ins))
+
+            csample.KeyIndex.build(sampled).save(path)
+            with csample.KeyIndex.load(path) as index:
+                self.assertEqual(sampled, set(i for i in ins if i in index))
+
+            csample.KeyIndex.build([]).save(path)
+            self.assertEqual(0, len(csample.KeyIndex.load(path)))
+
+            with open(path, 'wb') as f:
+                f.write(b'garbage')
+            self.assertRaises(ValueError, csample.KeyIndex.load, path)
+
+            # Cut off in the middle of a hash value
+            csample.KeyIndex.build(ins).save(path)
+            with open(path, 'rb+') as f:
+                f.truncate(os.path.getsize(path) - 1)
+            self.assertRaises(ValueError, csample.KeyIndex.load, path)
+        finally:
+            os.remove(path)
+
 
 class SamplingTest(unittest.TestCase):
     def test_sampling_rate_accuracy(self):
@@ -126,6 +679,161 @@ class SamplingTest(unittest.TestCase):
         for ratio in ratios:
             self.assertEqual(n_sample / n_pop, ratio)
 
+    def test_skipping_reservoir_sampling(self):
+        n_pop = 10
+        n_sample = 3
+        trials = 50000
+
+        population = list(range(n_pop))
+        counters = [0] * n_pop
+        for _ in range(trials):
+            samples = csample.reservoir(population, n_sample, algorithm='L')
+            self.assertEqual(n_sample, len(set(samples)))
+            for s in samples:
+                counters[s] += 1
+
+        for c in counters:
+            self.assertAlmostEqual(n_sample / n_pop, c / trials, 2)
+
+        seeded = csample.reservoir(range(100000), 10, 'a', keep_order=True, algorithm='L')
+        self.assertEqual(seeded, csample.reservoir(range(100000), 10, 'a', keep_order=True, algorithm='L'))
+        self.assertEqual(sorted(seeded), seeded)
+        self.assertRaises(ValueError, csample.reservoir, population, 2, algorithm='X')
+
+    def test_incremental_reservoir_sampling(self):
+        sampler = csample.ReservoirSampler(10, seed='a')
+        for i in range(1000):
+            sampler.add(i)
+        self.assertEqual(1000, sampler.count)
+        self.assertEqual(10, len(set(sampler.snapshot())))
+
+        other = csample.ReservoirSampler(10, seed='a')
+        other.extend(range(1000))
+        self.assertEqual(sampler.snapshot(), other.snapshot())
+
+    def test_order_preserving_reservoir_snapshots(self):
+        sampler = csample.ReservoirSampler(10, keep_order=True)
+        for i in range(0, 1000, 100):
+            sampler.extend(range(i, i + 100))
+            snapshot = sampler.snapshot()
+            self.assertEqual(sorted(snapshot), snapshot)
+
+        other = csample.ReservoirSampler(10, keep_order=True)
+        other.extend(range(1000, 2000))
+        merged = csample.ReservoirSampler.from_bytes(sampler.to_bytes()).merge(other)
+        self.assertEqual(2000, merged.count)
+        self.assertEqual(sorted(merged.snapshot()), merged.snapshot())
+        merged.extend(range(2000, 3000))
+        self.assertEqual(sorted(merged.snapshot()), merged.snapshot())
+
+    def test_merging_reservoir_sampling(self):
+        shards = [list(range(0, 2)), list(range(2, 8)), list(range(8, 10))]
+        trials = 10000
+
+        counters = [0] * 10
+        for _ in range(trials):
+            merged = csample.ReservoirSampler(3)
+            for shard in shards:
+                part = csample.ReservoirSampler(3)
+                part.extend(shard)
+                merged.merge(csample.ReservoirSampler.from_bytes(part.to_bytes()))
+            self.assertEqual(10, merged.count)
+            samples = merged.snapshot()
+            self.assertEqual(3, len(set(samples)))
+            for s in samples:
+                counters[s] += 1
+
+        for c in counters:
+            self.assertAlmostEqual(0.3, c / trials, 1)
+
+        self.assertRaises(ValueError, csample.ReservoirSampler(3).merge, csample.ReservoirSampler(4))
+        self.assertRaises(ValueError, csample.ReservoirSampler.from_bytes, b'garbage')
+
+    def test_bottom_k_sampling(self):
+        data = [('user%d' % (i % 1000), i) for i in range(5000)]
+        samples = csample.bottom_k(data, 50, 0)
+
+        func = csample._hash_with_seed('xxhash32', 'DEFAULT_SEED')
+        smallest = sorted(set(func(l[0]) for l in data))[:50]
+        expected = [l for l in data if func(l[0]) <= smallest[-1]]
+        self.assertEqual(expected, samples)
+        self.assertEqual(250, len(samples))
+
+        sampler = csample.BottomKSampler(256, 0)
+        sampler.extend(('user%d' % i, i) for i in range(20000))
+        self.assertAlmostEqual(1.0, sampler.estimate_distinct() / 20000, 0)
+
+        sampler = csample.BottomKSampler(8)
+        sampler.extend(['alan', 'brad', 'alan', 'cate'])
+        self.assertEqual(3.0, sampler.estimate_distinct())
+
+    def test_merging_bottom_k_sampling(self):
+        data = [('user%d' % (i % 300), i) for i in range(3000)]
+        whole = csample.BottomKSampler(20, 0)
+        whole.extend(data)
+
+        merged = csample.BottomKSampler(20, 0)
+        for start in range(0, 3000, 700):
+            part = csample.BottomKSampler(20, 0)
+            part.extend(data[start:start + 700])
+            merged.merge(csample.BottomKSampler.from_bytes(part.to_bytes()))
+        self.assertEqual(3000, merged.count)
+        self.assertEqual(whole.snapshot(), merged.snapshot())
+        self.assertEqual(whole.estimate_distinct(), merged.estimate_distinct())
+
+        index = merged.to_key_index()
+        self.assertEqual(20, len(index))
+        self.assertTrue(all(l[0] in index for l in merged.snapshot()))
+
+        self.assertRaises(ValueError, merged.merge, csample.BottomKSampler(20, 0, seed='other'))
+        self.assertRaises(ValueError, csample.BottomKSampler.from_bytes, b'garbage')
+
+    def test_window_sampling(self):
+        trials = 2000
+        counters = [0] * 100
+        for seed in range(trials):
+            sampler = csample.WindowSampler(5, 100, col=0, seed=seed)
+            sampler.extend((t, 'event') for t in range(1000))
+            samples = sampler.snapshot()
+            self.assertEqual(5, len(samples))
+            self.assertEqual(sorted(samples), samples)
+            for t, _ in samples:
+                counters[t - 900] += 1
+        for c in counters:
+            self.assertAlmostEqual(0.05, c / trials, 1)
+
+        # Memory stays bounded by the window, not the stream
+        self.assertTrue(len(sampler._entries) < 100)
+        self.assertEqual(1000, sampler.count)
+        self.assertEqual([(999, 'event')], sampler.snapshot(now=1098))
+        self.assertEqual([], sampler.snapshot(now=2000))
+
+        sampler = csample.WindowSampler(3, 60)
+        sampler.add('alan', timestamp=0)
+        sampler.add('brad')
+        self.assertEqual(['brad'], sampler.snapshot())
+
+    def test_weighted_reservoir_sampling(self):
+        population = [(i, i + 1) for i in range(4)]
+        trials = 40000
+
+        counters = [0] * len(population)
+        for _ in range(trials):
+            samples = csample.weighted_reservoir(population, 1, 1)
+            for i, _ in samples:
+                counters[i] += 1
+
+        for i, c in enumerate(counters):
+            self.assertAlmostEqual((i + 1) / 10, c / trials, 2)
+
+        population = [(i, i % 7) for i in range(10000)]
+        seeded = csample.weighted_reservoir(population, 10, 1, 'a', keep_order=True)
+        self.assertEqual(seeded, csample.weighted_reservoir(population, 10, 1, 'a', keep_order=True))
+        self.assertEqual(sorted(seeded), seeded)
+        self.assertTrue(all(w > 0 for _, w in seeded))
+        self.assertEqual([], csample.weighted_reservoir(population, 0, 1))
+        self.assertRaises(ValueError, csample.weighted_reservoir, [('a', -1)], 1, 1)
+
     def test_seeded_reservoir_sampling(self):
         population = list(range(10000))
         n_sample = 10
@@ -140,6 +848,34 @@ class SamplingTest(unittest.TestCase):
         self.assertEqual(seed_a0, seed_a1)
         self.assertNotEqual(seed_a0, seed_b)
 
+    def test_private_random_state(self):
+        import random
+        import threading
+
+        population = list(range(10000))
+        tuples = [(i, i % 7 + 1) for i in range(10000)]
+        random.seed(1)
+        expected = random.random()
+        random.seed(1)
+        csample.reservoir(population, 10, 'a')
+        csample.reservoir(population, 10, 'a', algorithm='L')
+        csample.weighted_reservoir(tuples, 10, 1, 'a')
+        self.assertEqual(expected, random.random())
+
+        seeds = ['seed%d' % i for i in range(8)]
+        sequential = [csample.reservoir(population, 10, seed, algorithm='L') for seed in seeds]
+        parallel = [None] * len(seeds)
+
+        def run(i):
+            parallel[i] = csample.reservoir(population, 10, seeds[i], algorithm='L')
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(len(seeds))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sequential, parallel)
+
     def test_order_preserving_reservoir_sampling(self):
         population = list(range(100))
         sampled = csample.reservoir(population, 10, keep_order=True)
@@ -165,6 +901,104 @@ class SamplingTest(unittest.TestCase):
         self.assertAlmostEqual(len(partitions[1]) / len(ins), 0.3, 2)
         self.assertAlmostEqual(len(partitions[2]) / len(ins), 0.5, 2)
 
+    def test_partitioning_consumed_out_of_order(self):
+        ins = [str(i) for i in range(0, 1000)]
+        assigner = csample.HashSampler().assign_for([0.2, 0.3, 0.5])
+        expected = [[], [], []]
+        for i in ins:
+            expected[assigner(i)].append((i,))
+
+        calls = []
+        counting = (calls.append(i) or (i,) for i in ins)
+        partitions = csample.partition_tuple(counting, [0.2, 0.3, 0.5], 0)
+        self.assertEqual(expected[::-1], [list(p) for p in reversed(partitions)])
+        self.assertEqual(len(ins), len(calls))
+
+    def test_sample_tiers(self):
+        ins = [str(i) for i in range(0, 1000)]
+        rates = [0.1, 0.5, 0.01]
+        tiers = [[], [], []]
+        counts = csample.sample_line_tiers(ins, rates, tiers)
+        for rate, tier, count in zip(rates, tiers, counts):
+            self.assertEqual(list(csample.sample_line(ins, rate)), tier)
+            self.assertEqual(len(tier), count)
+
+        tiers = [[], []]
+        csample.sample_tuple_tiers([(i,) for i in ins], [0.3, 0.2], 0, tiers)
+        self.assertEqual(list(csample.sample_tuple([(i,) for i in ins], 0.2, 0)), tiers[1])
+
+    def test_partitioning_into_sinks(self):
+        ins = [str(i) for i in range(0, 1000)]
+        expected = [list(p) for p in csample.partition_line(ins, [0.2, 0.3, 0.5])]
+
+        first, second, third = [], StringIO(), []
+        counts = csample.partition_line_into(ins, [0.2, 0.3, 0.5], [first, second.write, third.append])
+        self.assertEqual([len(p) for p in expected], counts)
+        self.assertEqual(expected[0], first)
+        self.assertEqual(''.join(expected[1]), second.getvalue())
+        self.assertEqual(expected[2], third)
+
+
+@unittest.skipIf(sys.version_info < (3, 6), 'asyncio adapters need Python 3.6+')
+class AsyncAPITest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def drain(self, agen):
+        outs = []
+        while True:
+            try:
+                outs.append(self.loop.run_until_complete(agen.__anext__()))
+            except StopAsyncIteration:
+                return outs
+
+    def test_sample_async(self):
+        ins = [(str(i), i) for i in range(0, 1000)]
+        expected = list(csample.sample_tuple(ins, 0.5, 0))
+        self.assertEqual(expected, self.drain(csample_aio.sample_tuple_async(ins, 0.5, 0, batch_size=7)))
+
+        lines = [str(i) for i in range(0, 1000)]
+        sampled = csample_aio.sample_line_async(lines, 0.5)
+        self.assertEqual(list(csample.sample_line(lines, 0.5)), self.drain(sampled))
+
+        # Async iterables are accepted as well
+        resampled = csample_aio.sample_tuple_async(csample_aio.sample_tuple_async(ins, 0.5, 0), 0.3, 0)
+        self.assertEqual(list(csample.sample_tuple(expected, 0.3, 0)), self.drain(resampled))
+
+    def test_partition_async(self):
+        ins = [str(i) for i in range(0, 1000)]
+        ratios = [0.2, 0.3, 0.5]
+        expected = [list(p) for p in csample.partition_line(ins, ratios)]
+
+        for source in (ins, csample_aio.sample_line_async(ins, 1.0)):
+            queues = [asyncio.Queue() for _ in ratios]
+            counts = self.loop.run_until_complete(csample_aio.partition_line_async(source, ratios, queues))
+            self.assertEqual([len(p) for p in expected], counts)
+            for partition, queue in zip(expected, queues):
+                self.assertEqual(partition + [None], [queue.get_nowait() for _ in range(queue.qsize())])
+
+    def test_partition_async_backpressure(self):
+        ins = [(str(i),) for i in range(0, 100)]
+        queues = [asyncio.Queue(maxsize=1), asyncio.Queue(maxsize=1)]
+
+        async_partition = csample_aio.partition_tuple_async(ins, [0.5, 0.5], 0, queues, close=False)
+        task = self.loop.create_task(async_partition)
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+        self.assertFalse(task.done())
+
+        received = []
+        while not task.done() or any(q.qsize() for q in queues):
+            for queue in queues:
+                while queue.qsize():
+                    received.append(queue.get_nowait())
+            self.loop.run_until_complete(asyncio.sleep(0))
+        self.assertEqual(sorted(ins), sorted(received))
+
 
 if __name__ == '__main__':
     unittest.main()